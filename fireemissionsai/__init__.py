@@ -3,4 +3,13 @@
 The package includes the following modules;
 preprocess - for converting GFED hdf files to training examples for the predict module.
 predict - A utility for training a CNN to predict future values in the GFED data.
+dataset - for reading and writing the training example splits as .csv or .npy files.
+serve - a resident server predicting micro-batches of requests with a loaded model.
+synthetic - for generating GFED format files of any grid size for testing.
+benchmark - for timing the preprocess and predict hot paths on synthetic GFED files.
+metrics - for timing stages, counting throughput, and throttling progress output.
+engine - for predicting with a trained model using NumPy alone, without TensorFlow.
+cache - for keeping decoded GFED month datasets on disk between preprocess runs.
+roi - for narrowing preprocessing to a region of interest in space and time.
+evaluation - for streaming errors of a model's predictions per value and region.
 """
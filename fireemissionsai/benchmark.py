@@ -0,0 +1,232 @@
+"""The benchmark module times the preprocess and predict hot paths on synthetic GFED
+files, reporting entries per second for each as JSON so regressions show up.
+
+The benchmarks cover parsing entries cell by cell and from month slabs, parsing
+whole column blocks, with and without 5x5 neighbourhoods or a warm slab cache,
+subsampling cell by cell and stratified sampling of blocks, writing splits as
+.csv and .npy, and batch inference with the NumPy engine and, when it is
+installed, Keras. Files are generated with the synthetic module at the requested
+grid size, unless a directory of GFED files is given.
+
+Passing --baseline with an earlier report compares the two, listing every
+benchmark that got slower by more than --tolerance and exiting with status 1.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+from contextlib import ExitStack, redirect_stdout
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import h5py
+import numpy as np
+
+from fireemissionsai import dataset, engine, preprocess, synthetic
+from fireemissionsai.cache import SlabCache
+
+def result(rows, seconds):
+    """Gets a benchmark result record for rows processed in a number of seconds."""
+    return {
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds if seconds > 0 else float("inf")
+    }
+
+def bench_next(files, limit, **options):
+    """Times parsing up to limit entries one at a time with GFEDDataParser.next."""
+    parser = preprocess.GFEDDataParser(files, **options)
+    rows, start = 0, time.perf_counter()
+    while parser.has_next() and rows < limit:
+        parser.next()
+        rows += 1
+    return result(rows, time.perf_counter() - start)
+
+def bench_blocks(files, limit, **options):
+    """Times parsing column blocks with GFEDDataParser.next_block until limit rows."""
+    parser = preprocess.GFEDDataParser(files, slabs=True, **options)
+    rows, start = 0, time.perf_counter()
+    while parser.has_next_block() and rows < limit:
+        rows += len(parser.next_block()[0])
+    return result(rows, time.perf_counter() - start)
+
+def bench_subsample(files, limit, ratio, **options):
+    """Times collecting up to limit entries with get_subsample."""
+    parser = preprocess.GFEDDataParser(files, **options)
+    rows, start = 0, time.perf_counter()
+    for entries in preprocess.subsamples(parser, ratio):
+        rows += len(entries)
+        if rows >= limit:
+            break
+    return result(rows, time.perf_counter() - start)
+
+def bench_stratified(files, limit, ratio, **options):
+    """Times sampling column blocks with sampled_blocks until limit rows are kept."""
+    parser = preprocess.GFEDDataParser(files, slabs=True, **options)
+    rows, start = 0, time.perf_counter()
+    for features, _, _ in preprocess.sampled_blocks(parser, ratio):
+        rows += len(features)
+        if rows >= limit:
+            break
+    return result(rows, time.perf_counter() - start)
+
+def bench_write(features, targets, file_format):
+    """Times writing rows one at a time to every split in a file format."""
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            writers = dataset.open_writers(directory, file_format, stack)
+            for count, (feature_row, target_row) in enumerate(zip(features, targets), 1):
+                features_writer, targets_writer = writers[preprocess.entry_split(count)]
+                features_writer.writerow(feature_row)
+                targets_writer.writerow(target_row)
+        return result(len(features), time.perf_counter() - start)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_keras_inference(features, targets, batch_size):
+    """Times predicting rows in batches with a freshly constructed Keras model."""
+    from fireemissionsai import predict # pylint: disable=import-outside-toplevel
+    model = predict.construct_model(features.shape[1], targets.shape[1])
+    model.predict(features[:batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    model.predict(features, batch_size=batch_size)
+    return result(len(features), time.perf_counter() - start)
+
+def bench_numpy_inference(features, targets, batch_size):
+    """Times predicting rows in batches with the NumPy engine and random model weights."""
+    rng = np.random.RandomState(0)
+    sizes = (features.shape[1], 412, 412, 412, targets.shape[1])
+    model = engine.NumpyModel([
+        (rng.randn(inputs, units) / inputs, np.ones(inputs), np.zeros(inputs), np.zeros(units),
+         "relu")
+        for inputs, units in zip(sizes[:-1], sizes[1:])
+    ])
+    start = time.perf_counter()
+    model.predict(features, batch_size=batch_size)
+    return result(len(features), time.perf_counter() - start)
+
+def run(paths, limit=20000, ratio=5, batch_size=1024):
+    """Runs every benchmark on the GFED files at paths and returns a dict of results."""
+    results = {}
+    files = [h5py.File(path, "r") for path in paths]
+    try:
+        land_cells = preprocess.load_land_cells(files)
+        # Reading cell by cell from compressed HDF datasets is very slow, so time fewer rows.
+        results["parse_next_cells"] = bench_next(files, max(limit // 100, 1))
+        results["parse_next_slabs"] = bench_next(files, limit, slabs=True)
+        results["parse_next_land_slabs"] = bench_next(
+            files, limit, slabs=True, land_cells=land_cells
+        )
+        results["parse_blocks"] = bench_blocks(files, limit * 10)
+        results["parse_blocks_land"] = bench_blocks(files, limit * 10, land_cells=land_cells)
+        results["parse_blocks_window5"] = bench_blocks(files, limit * 10, window=5)
+        cache_directory = tempfile.mkdtemp()
+        try:
+            # The first pass fills the cache so the timed pass reads from it.
+            bench_blocks(files, limit * 10, cache=SlabCache(cache_directory))
+            results["parse_blocks_cached"] = bench_blocks(
+                files, limit * 10, cache=SlabCache(cache_directory)
+            )
+        finally:
+            shutil.rmtree(cache_directory)
+        results["subsample_cells"] = bench_subsample(files, max(limit // 100, 1), ratio)
+        results["subsample_land_slabs"] = bench_subsample(
+            files, limit, ratio, slabs=True, land_cells=land_cells
+        )
+        results["sample_stratified"] = bench_stratified(files, limit, ratio)
+
+        parser = preprocess.GFEDDataParser(files, slabs=True, land_cells=land_cells)
+        blocks = []
+        while parser.has_next_block() and sum(len(block[0]) for block in blocks) < limit:
+            blocks.append(parser.next_block())
+        features = np.concatenate([block[0] for block in blocks])[:limit]
+        targets = np.concatenate([block[1] for block in blocks])[:limit]
+    finally:
+        for hdf in files:
+            hdf.close()
+
+    for file_format in dataset.FORMATS:
+        results["write_" + file_format] = bench_write(features, targets, file_format)
+    results["inference_numpy"] = bench_numpy_inference(features, targets, batch_size)
+    try:
+        results["inference_keras"] = bench_keras_inference(features, targets, batch_size)
+    except ImportError:
+        pass
+    return results
+
+def regressions(report, baseline, tolerance):
+    """Lists benchmarks in both reports whose rows per second fell by more than tolerance."""
+    slower = []
+    for name, current in report["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        if current["rows_per_second"] < previous["rows_per_second"] * (1 - tolerance):
+            slower.append("{}: {:.1f} rows/s down from {:.1f} rows/s".format(
+                name, current["rows_per_second"], previous["rows_per_second"]
+            ))
+    return slower
+
+def benchmark(directory=None, years=2, shape=(180, 360), land_fraction=0.3, seed=0, **options):
+    """Generates synthetic files, unless a directory is given, benchmarks them, and reports.
+
+    Returns a JSON serialisable report of the configuration, environment, and results.
+    """
+    generated = directory is None
+    if generated:
+        directory = tempfile.mkdtemp()
+        synthetic.generate(directory, years, shape, land_fraction, seed=seed)
+    try:
+        paths = [
+            os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if preprocess.valid_hdf_file(os.path.join(directory, name))
+        ]
+        with redirect_stdout(sys.stderr):
+            results = run(paths, **options)
+    finally:
+        if generated:
+            shutil.rmtree(directory)
+    return {
+        "config": dict(options, years=len(paths), shape=list(shape), land_fraction=land_fraction,
+                       generated=generated),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "h5py": h5py.__version__,
+            "machine": platform.machine()
+        },
+        "results": results
+    }
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    PARSER.add_argument("--directory", help="Directory of GFED files to use instead of synthetic")
+    PARSER.add_argument("--years", type=int, help="No. of synthetic yearly files", default=2)
+    PARSER.add_argument("--shape", type=int, nargs=2, help="Synthetic grid rows and columns",
+                        default=(180, 360))
+    PARSER.add_argument("--land", type=float, help="Synthetic fraction of land cells", default=0.3)
+    PARSER.add_argument("--limit", type=int, help="Rows to time each benchmark over", default=20000)
+    PARSER.add_argument("--ratio", type=int, help="Subsample negative ratio", default=5)
+    PARSER.add_argument("--batch-size", type=int, help="Inference batch size", default=1024)
+    PARSER.add_argument("--output", help="Path to write the JSON report to, as well as stdout")
+    PARSER.add_argument("--baseline", help="Earlier JSON report to check for regressions against")
+    PARSER.add_argument("--tolerance", type=float, help="Allowed fractional slowdown", default=0.2)
+    ARGS = PARSER.parse_args()
+
+    REPORT = benchmark(ARGS.directory, ARGS.years, tuple(ARGS.shape), ARGS.land,
+                       limit=ARGS.limit, ratio=ARGS.ratio, batch_size=ARGS.batch_size)
+    print(json.dumps(REPORT, indent=2))
+    if ARGS.output:
+        with open(ARGS.output, "w") as REPORT_FILE:
+            json.dump(REPORT, REPORT_FILE, indent=2)
+    if ARGS.baseline:
+        with open(ARGS.baseline) as BASELINE_FILE:
+            SLOWER = regressions(REPORT, json.load(BASELINE_FILE), ARGS.tolerance)
+        for LINE in SLOWER:
+            print("Regression " + LINE, file=sys.stderr)
+        sys.exit(1 if SLOWER else 0)
@@ -0,0 +1,98 @@
+"""The cache module keeps decoded GFED month datasets on local disk, so repeated
+preprocessing runs over the same files skip HDF decompression.
+
+Each (year, month, variable) array is saved as an uncompressed float32 .npy file
+and read back memory-mapped. File names also hold the size and modification
+time of the HDF file the array was read from, so arrays of a file that has
+changed are never read and simply age out. The cache is capped at a number of
+bytes, evicting the least recently used arrays first, where use is tracked by
+each file's modification time. Arrays are written to a temporary file and
+renamed into place, so worker processes can share a cache directory.
+"""
+
+import os
+
+import numpy as np
+
+# Default cap on the bytes of arrays kept in a cache directory.
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+class SlabCache:
+    """A directory of decoded month arrays keyed on (year, month, variable)."""
+
+    def __init__(self, directory: str, max_bytes=DEFAULT_MAX_BYTES):
+        """Arrays are kept in directory, created if needed, up to max_bytes in total."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key, source):
+        """Gets the path of the array for a (year, month, variable) key of a source signature.
+
+        source is the dict of the HDF file's size and mtime_ns, see
+        preprocess.file_signature.
+        """
+        year, month, variable = key
+        return os.path.join(self.directory, "{}-{:02d}-{}-{}-{}.npy".format(
+            year, month, variable.replace("/", "_"), source["size"], source["mtime_ns"]
+        ))
+
+    def get(self, key, source):
+        """Gets a read only memory-mapped array for a key, or None if it is not cached."""
+        path = self.path(key, source)
+        try:
+            array = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return array
+
+    def put(self, key, source, array):
+        """Saves an array for a key as float32, evicting old arrays to stay under the cap.
+
+        Arrays larger than the cap are not saved. Returns the array as float32.
+        """
+        array = np.asarray(array, dtype=np.float32)
+        if array.nbytes > self.max_bytes:
+            return array
+        path = self.path(key, source)
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "wb") as array_file:
+            np.save(array_file, array)
+        os.replace(temporary, path)
+        self.evict(keep=path)
+        return array
+
+    def entries(self):
+        """Lists the (modification time, bytes, path) of every cached array, oldest first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".npy"):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """Removes the least recently used arrays, other than keep, until under the cap."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def size(self):
+        """Gets the bytes of arrays in the cache."""
+        return sum(size for _, size, _ in self.entries())
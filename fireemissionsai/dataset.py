@@ -0,0 +1,344 @@
+"""The dataset module reads and writes the train, validation, and test splits that
+the preprocess module produces and the predict module trains on.
+
+Splits are written as a features and a targets file each, either as .csv files
+or as typed float32 .npy files. The .npy files are written incrementally and
+can be opened memory-mapped, without any text parsing, by the predict module.
+Writing splits in one format removes any split files of the other, as .npy
+files are read in preference to .csv files.
+
+Splits can also be read back in fixed-size blocks and regrouped into shuffled
+batches with bounded memory, for training on datasets larger than memory.
+
+Writers report their state, the bytes written so far, so a checkpointed run
+can reopen its split files truncated to that state and append to them.
+
+Run on its own the module exports the .npy splits in a directory to .csv files.
+"""
+
+import os
+import csv
+import queue
+import struct
+import threading
+from itertools import islice
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import numpy as np
+
+# Names of the splits examples are written to.
+SPLITS = ("train", "validation", "test")
+# File formats splits can be written in.
+FORMATS = ("csv", "npy")
+# Bytes reserved for the .npy header so it can be rewritten with the final shape.
+NPY_HEADER_LENGTH = 128
+# Rows buffered by an NpyWriter before they are written to disk.
+NPY_BUFFER_ROWS = 4096
+
+def split_path(directory: str, split: str, kind: str, file_format: str):
+    """Gets the path of the features or targets file of a split."""
+    return os.path.join(directory, "{}-{}.{}".format(split, kind, file_format))
+
+class CsvWriter:
+    """Writes rows to a .csv file with a csv writer, keeping the file for its state.
+
+    If a state from an earlier writer is given the file is truncated to it
+    and appended to.
+    """
+
+    def __init__(self, path: str, state=None):
+        self.path = path
+        if state is None:
+            self.file = open(path, "w")
+        else:
+            self.file = open(path, "r+")
+            self.file.truncate(state["offset"])
+            self.file.seek(0, os.SEEK_END)
+        self.writer = csv.writer(self.file)
+
+    def writerow(self, row):
+        """Writes a single row."""
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        """Writes a sequence of rows."""
+        self.writer.writerows(rows)
+
+    def state(self):
+        """Flushes the file and gets the bytes written, to reopen it with later."""
+        self.file.flush()
+        return {"offset": self.file.tell()}
+
+    def close(self):
+        """Closes the file."""
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class NpyWriter:
+    """Appends rows to a 2D .npy file with the same interface as a csv writer.
+
+    The header is written with the final number of rows when the writer is
+    closed, so the file is only a valid .npy file once close has been called.
+    If a state from an earlier writer is given the file is truncated to it
+    and appended to, whether or not the earlier writer was closed.
+    """
+
+    def __init__(self, path: str, dtype=np.float32, state=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.rows, self.columns = 0, None
+        self.buffer = []
+        if state is None:
+            self.file = open(path, "wb")
+            self.file.write(b"\0" * NPY_HEADER_LENGTH)
+        else:
+            self.file = open(path, "r+b")
+            self.file.truncate(state["offset"])
+            self.file.seek(0, os.SEEK_END)
+            self.columns = state["columns"]
+            if self.columns:
+                self.rows = (state["offset"] - NPY_HEADER_LENGTH) // (
+                    self.columns * self.dtype.itemsize
+                )
+
+    def header(self):
+        """Gets the .npy header bytes for the rows written so far, padded to length."""
+        shape = (self.rows, self.columns or 0)
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(self.dtype), shape
+        )
+        prefix = np.lib.format.magic(1, 0)
+        header = header.ljust(NPY_HEADER_LENGTH - len(prefix) - 3) + "\n"
+        return prefix + struct.pack("<H", len(header)) + header.encode("latin1")
+
+    def writerow(self, row):
+        """Buffers a single row, writing the buffer out once it is full."""
+        self.buffer.append(row)
+        if len(self.buffer) >= NPY_BUFFER_ROWS:
+            self.flush()
+
+    def writerows(self, rows):
+        """Writes a 2D array, or sequence of rows, after any buffered rows."""
+        self.flush()
+        self.write_array(np.asarray(rows, dtype=self.dtype))
+
+    def write_array(self, array):
+        """Writes a 2D array of rows directly to the file."""
+        if len(array) == 0:
+            return
+        if self.columns is None:
+            self.columns = array.shape[1]
+        elif array.shape[1] != self.columns:
+            raise ValueError("Expected {} columns but got {} in '{}'".format(
+                self.columns, array.shape[1], self.path
+            ))
+        self.file.write(np.ascontiguousarray(array, dtype=self.dtype).tobytes())
+        self.rows += len(array)
+
+    def flush(self):
+        """Writes out any buffered rows."""
+        if len(self.buffer) > 0:
+            self.write_array(np.asarray(self.buffer, dtype=self.dtype))
+            self.buffer = []
+
+    def state(self):
+        """Writes out buffered rows and gets the bytes and columns written, to reopen it with."""
+        self.flush()
+        self.file.flush()
+        return {"offset": self.file.tell(), "columns": self.columns}
+
+    def close(self):
+        """Writes out buffered rows and the final header, then closes the file."""
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_writers(directory: str, file_format: str, stack, states=None):
+    """Opens a (features, targets) writer pair for each split in the given format.
+
+    Files are registered with the contextlib.ExitStack provided, so they are
+    closed, and .npy headers completed, when the stack exits. If states from
+    writer_states are given, existing files are reopened from them instead.
+    Split files of the other format are removed, so they are not read in
+    place of the files written.
+    """
+    if file_format not in FORMATS:
+        raise ValueError("Unknown dataset format '{}'".format(file_format))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    writers = {}
+    for split in SPLITS:
+        paths = [
+            split_path(directory, split, kind, file_format) for kind in ("features", "targets")
+        ]
+        for other_format in FORMATS:
+            for kind in ("features", "targets"):
+                other_path = split_path(directory, split, kind, other_format)
+                if other_format != file_format and os.path.isfile(other_path):
+                    os.remove(other_path)
+        split_states = states[split] if states is not None else (None, None)
+        writer = NpyWriter if file_format == "npy" else CsvWriter
+        writers[split] = tuple(
+            stack.enter_context(writer(path, state=state))
+            for path, state in zip(paths, split_states)
+        )
+    return writers
+
+def writer_states(writers):
+    """Gets the state of every writer from open_writers, to reopen them with later."""
+    return {split: [writer.state() for writer in pair] for split, pair in writers.items()}
+
+def load_split(split: str, kind: str, directory="output"):
+    """Loads the features or targets of a split as a 2D array.
+
+    A .npy file is preferred, and opened memory-mapped, falling back to
+    parsing a .csv file if there is no .npy file.
+    """
+    path = split_path(directory, split, kind, "npy")
+    if os.path.isfile(path):
+        return np.load(path, mmap_mode="r")
+    return np.genfromtxt(split_path(directory, split, kind, "csv"), delimiter=",", ndmin=2)
+
+def csv_blocks(path: str, block_rows=65536):
+    """Yields the rows of a .csv file as 2D arrays of up to block_rows rows."""
+    with open(path) as csv_file:
+        lines = list(islice(csv_file, block_rows))
+        while len(lines) > 0:
+            yield np.loadtxt(lines, delimiter=",", ndmin=2)
+            lines = list(islice(csv_file, block_rows))
+
+def prefetched(iterable, depth=1):
+    """Yields the items of an iterable while a background thread produces the next ones.
+
+    At most depth items are produced ahead of the consumer. Exceptions raised
+    by the iterable are re-raised in the consuming thread.
+    """
+    items = queue.Queue(maxsize=depth)
+    finished = object()
+    stopped = threading.Event()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((finished, None))
+        except Exception as error: # pylint: disable=broad-except
+            put((finished, error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        item, error = items.get()
+        while item is not finished:
+            yield item
+            item, error = items.get()
+        if error is not None:
+            raise error
+    finally:
+        stopped.set()
+
+def split_shape(split: str, kind: str, directory="output"):
+    """Gets the (rows, columns) shape of a split file without loading its values."""
+    path = split_path(directory, split, kind, "npy")
+    if os.path.isfile(path):
+        return np.load(path, mmap_mode="r").shape
+    rows, columns = 0, 0
+    with open(split_path(directory, split, kind, "csv")) as csv_file:
+        for line in csv_file:
+            if rows == 0:
+                columns = len(line.split(","))
+            rows += 1
+    return (rows, columns)
+
+def read_blocks(split: str, directory="output", block_rows=65536):
+    """Yields (features, targets) pairs of arrays of up to block_rows rows from a split.
+
+    Only one block of each file is held in memory at a time.
+    """
+    if os.path.isfile(split_path(directory, split, "features", "npy")):
+        features, targets = (load_split(split, kind, directory) for kind in ("features", "targets"))
+        for start in range(0, len(features), block_rows):
+            yield features[start:start + block_rows], targets[start:start + block_rows]
+        return
+    yield from zip(*(
+        csv_blocks(split_path(directory, split, kind, "csv"), block_rows)
+        for kind in ("features", "targets")
+    ))
+
+def batches(blocks, batch_size: int, buffer_rows=0, seed=None):
+    """Regroups (features, targets) blocks into batches of batch_size rows.
+
+    If buffer_rows is above 0, rows are gathered into a buffer of at least that
+    many rows, which is shuffled before its batches are taken. Rows left over
+    are carried into the next buffer, so memory is bounded by the buffer and
+    block sizes. Only the final batch may hold fewer than batch_size rows.
+    """
+    rng = np.random.RandomState(seed)
+    threshold = max(buffer_rows, batch_size)
+    pending_x, pending_y, rows = [], [], 0
+
+    def take(final):
+        buffer_x, buffer_y = np.concatenate(pending_x), np.concatenate(pending_y)
+        if buffer_rows > 0:
+            order = rng.permutation(len(buffer_x))
+            buffer_x, buffer_y = buffer_x[order], buffer_y[order]
+        end = len(buffer_x) if final else len(buffer_x) - (len(buffer_x) % batch_size)
+        taken = [
+            (buffer_x[start:start + batch_size], buffer_y[start:start + batch_size])
+            for start in range(0, end, batch_size)
+        ]
+        return taken, buffer_x[end:], buffer_y[end:]
+
+    for features, targets in blocks:
+        pending_x.append(np.asarray(features))
+        pending_y.append(np.asarray(targets))
+        rows += len(features)
+        if rows >= threshold:
+            taken, rest_x, rest_y = take(final=False)
+            yield from taken
+            pending_x, pending_y, rows = [rest_x], [rest_y], len(rest_x)
+    if rows > 0:
+        yield from take(final=True)[0]
+
+def export_csv(directory="output", chunk_rows=65536):
+    """Writes a .csv copy of every .npy split file in a directory."""
+    for split in SPLITS:
+        for kind in ("features", "targets"):
+            path = split_path(directory, split, kind, "npy")
+            if not os.path.isfile(path):
+                continue
+            array = np.load(path, mmap_mode="r")
+            with open(split_path(directory, split, kind, "csv"), "w") as csv_file:
+                for start in range(0, len(array), chunk_rows):
+                    np.savetxt(csv_file, array[start:start + chunk_rows], delimiter=",", fmt="%.9g")
+            print("Exported " + path)
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    PARSER.add_argument("directory", nargs="?", help="Directory with .npy splits", default="output")
+    ARGS = PARSER.parse_args()
+    export_csv(ARGS.directory)
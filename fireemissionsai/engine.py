@@ -0,0 +1,195 @@
+"""The engine module predicts with a trained model using NumPy alone, so predictions
+need neither Keras nor TensorFlow to be imported.
+
+A persisted Keras model_weights.h5 is exported, read with h5py, to a compact .npz
+file of Dense layer weights. BatchNormalization layers are folded into the Dense
+layer that follows them, which is exact as their moving averages are fixed once
+trained. Kernels can be stored as float32, float16, or int8 with a float32 scale
+per output column, and are expanded back to float32 when loaded. Folded scales
+are stored apart from the kernels, so kernels are quantised as they were trained,
+and are folded in once loaded. The forward pass is then a float32 matrix
+multiply, bias, and activation per layer, in batches.
+
+Run on its own the module exports a model, for example
+python -m fireemissionsai.engine model_weights.h5 --dtype float16
+"""
+
+import json
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import h5py
+import numpy as np
+
+# Kernel types weights can be exported as.
+DTYPES = ("float32", "float16", "int8")
+# Activations the forward pass supports, by their Keras names.
+ACTIVATIONS = {
+    "linear": lambda values: values,
+    "relu": lambda values: np.maximum(values, 0, out=values),
+    "sigmoid": lambda values: 1 / (1 + np.exp(-values)),
+    "tanh": np.tanh
+}
+# Layers that do nothing at inference time.
+IDENTITY_LAYERS = ("InputLayer", "Dropout")
+
+def layer_weights(group: h5py.Group):
+    """Gets a layer's weights from its HDF group keyed on name, such as kernel or gamma."""
+    weights = {}
+    for weight_name in group.attrs["weight_names"]:
+        weight_name = weight_name.decode("utf8") if isinstance(weight_name, bytes) else weight_name
+        weights[weight_name.split("/")[-1].split(":")[0]] = group[weight_name][()]
+    return weights
+
+def read_keras_layers(model_path: str):
+    """Reads a Keras model file's layers as (class name, config, weights) tuples, in order."""
+    with h5py.File(model_path, "r") as hdf:
+        config = hdf.attrs["model_config"]
+        config = json.loads(config.decode("utf8") if isinstance(config, bytes) else config)
+        layers = config["config"]
+        if isinstance(layers, dict):
+            layers = layers["layers"]
+        weights = hdf["model_weights"] if "model_weights" in hdf else hdf
+        return [
+            (
+                layer["class_name"],
+                layer["config"],
+                layer_weights(weights[layer["config"]["name"]])
+                if layer["config"]["name"] in weights else {}
+            )
+            for layer in layers
+        ]
+
+def fold_layers(keras_layers):
+    """Merges (class name, config, weights) layers into (kernel, scale, shift, bias, activation).
+
+    Each layer computes activation((x * scale + shift) K + bias) for its
+    kernel K, so a BatchNormalization y = x * scale + shift is merged into the
+    next Dense layer. NumpyModel folds it into the kernel and bias, as
+    x (scale K) + (shift K + bias), once the kernel is loaded. Keeping them
+    apart until then lets the kernel be quantised as it was trained. If no
+    Dense layer follows a BatchNormalization it becomes a Dense layer of its
+    own. Raises a ValueError for any other layer or activation that is not
+    supported.
+    """
+    layers, affine = [], None
+    for class_name, config, weights in keras_layers:
+        if class_name in IDENTITY_LAYERS:
+            continue
+        if class_name == "BatchNormalization":
+            size = len(weights["moving_mean"])
+            scale = weights.get("gamma", np.ones(size)) / np.sqrt(
+                weights["moving_variance"] + config.get("epsilon", 1e-3)
+            )
+            shift = weights.get("beta", np.zeros(size)) - weights["moving_mean"] * scale
+            if affine is not None:
+                scale, shift = affine[0] * scale, affine[1] * scale + shift
+            affine = (scale, shift)
+            continue
+        if class_name != "Dense":
+            raise ValueError("Unsupported layer '{}' of type {}".format(config["name"], class_name))
+        activation = config.get("activation", "linear")
+        if activation not in ACTIVATIONS:
+            raise ValueError("Unsupported activation '{}' of layer '{}'".format(
+                activation, config["name"]
+            ))
+        kernel = weights["kernel"]
+        bias = weights.get("bias", np.zeros(kernel.shape[1]))
+        if affine is None:
+            affine = (np.ones(len(kernel)), np.zeros(len(kernel)))
+        scale, shift = affine
+        affine = None
+        layers.append((kernel, scale, shift, bias, activation))
+    if affine is not None:
+        layers.append((np.eye(len(affine[0])), affine[0], affine[1], np.zeros(len(affine[0])),
+                       "linear"))
+    return [
+        tuple(np.asarray(values, dtype=np.float32) for values in layer[:4]) + (layer[4],)
+        for layer in layers
+    ]
+
+def export(model_path: str, output_path: str, dtype="float32"):
+    """Exports a Keras model file to an .npz file of folded layers with kernels of dtype.
+
+    int8 kernels are quantised symmetrically with a scale per output column.
+    The first layer's kernel is always kept as float32, as it is small and
+    unnormalised inputs, such as the year, magnify any rounding in it.
+    """
+    if dtype not in DTYPES:
+        raise ValueError("Unknown weights type '{}'".format(dtype))
+    layers = fold_layers(read_keras_layers(model_path))
+    arrays = {"activations": np.array([layer[4] for layer in layers])}
+    for index, (kernel, scale, shift, bias, _) in enumerate(layers):
+        arrays["scale_{}".format(index)] = scale
+        arrays["shift_{}".format(index)] = shift
+        arrays["bias_{}".format(index)] = bias
+        if index == 0 or dtype == "float32":
+            arrays["kernel_{}".format(index)] = kernel
+        elif dtype == "int8":
+            columns = np.abs(kernel).max(axis=0) / 127
+            columns[columns == 0] = 1
+            arrays["kernel_{}".format(index)] = np.round(kernel / columns).astype(np.int8)
+            arrays["columns_{}".format(index)] = columns
+        else:
+            arrays["kernel_{}".format(index)] = kernel.astype(dtype)
+    np.savez(output_path, **arrays)
+    return output_path
+
+class NumpyModel:
+    """A stack of Dense layers predicting with NumPy, with a Keras like predict method."""
+
+    def __init__(self, layers):
+        """layers is a list of (kernel, scale, shift, bias, activation) tuples, see fold_layers.
+
+        Each layer's scale and shift are folded into its kernel and bias.
+        """
+        self.layers = []
+        for kernel, scale, shift, bias, activation in layers:
+            kernel = np.asarray(kernel, dtype=np.float64)
+            self.layers.append((
+                (np.asarray(scale)[:, np.newaxis] * kernel).astype(np.float32),
+                (np.asarray(shift) @ kernel + bias).astype(np.float32),
+                activation
+            ))
+
+    def predict(self, inputs, batch_size=65536):
+        """Predicts the rows of a 2D array of inputs, batch_size rows at a time."""
+        inputs = np.asarray(inputs, dtype=np.float32)
+        outputs = np.empty((len(inputs), self.layers[-1][0].shape[1]), dtype=np.float32)
+        for start in range(0, len(inputs), batch_size):
+            values = inputs[start:start + batch_size]
+            for kernel, bias, activation in self.layers:
+                values = values @ kernel
+                values += bias
+                values = ACTIVATIONS[activation](values)
+            outputs[start:start + batch_size] = values
+        return outputs
+
+def load(path: str):
+    """Loads an exported .npz file as a NumpyModel, expanding its kernels to float32."""
+    with np.load(path) as archive:
+        layers = []
+        for index, activation in enumerate(archive["activations"]):
+            kernel = archive["kernel_{}".format(index)].astype(np.float32)
+            if "columns_{}".format(index) in archive:
+                kernel *= archive["columns_{}".format(index)]
+            scale, shift, bias = (
+                archive["{}_{}".format(name, index)] for name in ("scale", "shift", "bias")
+            )
+            layers.append((kernel, scale, shift, bias, str(activation)))
+    return NumpyModel(layers)
+
+def from_keras(model_path: str):
+    """Loads a Keras model file as a float32 NumpyModel without exporting it."""
+    return NumpyModel(fold_layers(read_keras_layers(model_path)))
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    PARSER.add_argument("model", nargs="?", help="Persisted Keras model",
+                        default="model_weights.h5")
+    PARSER.add_argument("--output", help="Path of the exported weights",
+                        default="model_weights.npz")
+    PARSER.add_argument("--dtype", choices=DTYPES, help="Type to store kernels as",
+                        default="float32")
+    ARGS = PARSER.parse_args()
+    export(ARGS.model, ARGS.output, ARGS.dtype)
+    print("Exported {} weights of {} to {}".format(ARGS.dtype, ARGS.model, ARGS.output))
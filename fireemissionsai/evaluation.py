@@ -0,0 +1,102 @@
+"""The evaluation module scores a model's predictions of a dataset split against its
+targets in a single pass over blocks of rows, so memory stays constant however
+large the split grows.
+
+Errors are accumulated per target column, overall and per basis region ID, as
+running sums of the error, absolute error, and squared error, from which the
+mean absolute error, root mean squared error, and bias, the mean of predicted
+minus expected values, are reported as a compact JSON report.
+"""
+
+import json
+
+import numpy as np
+
+from fireemissionsai import dataset, preprocess
+from fireemissionsai.metrics import Metrics
+
+# Column of the features holding the basis region ID.
+REGION_COLUMN = 4
+# Names of the target columns, the values predicted for the following month.
+TARGET_NAMES = tuple(name.split("/")[-1] for name in preprocess.MONTHLY_DATASETS)
+
+class RunningErrors:
+    """Running sums of prediction errors per target column, overall and per region."""
+
+    def __init__(self, names=TARGET_NAMES):
+        self.names = names
+        self.rows = 0
+        # Sums of the error, absolute error, and squared error of each column.
+        self.sums = np.zeros((3, len(names)))
+        self.regions = {}
+
+    def add(self, predictions, targets, regions):
+        """Adds the errors of a block of predictions, with the region ID of each row."""
+        errors = np.asarray(predictions, dtype=np.float64) - np.asarray(targets, dtype=np.float64)
+        if errors.shape[1] != len(self.names):
+            raise ValueError("Expected {} target columns, not {}".format(
+                len(self.names), errors.shape[1]
+            ))
+        terms = np.stack([errors, np.abs(errors), errors ** 2])
+        self.sums += terms.sum(axis=1)
+        self.rows += len(errors)
+
+        ids, inverse = np.unique(np.asarray(regions), return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(ids))
+        sums = np.stack([
+            np.bincount(inverse, weights=column, minlength=len(ids))
+            for column in terms.transpose(0, 2, 1).reshape(-1, len(errors))
+        ], axis=1).reshape(len(ids), 3, len(self.names))
+        for region, count, region_sums in zip(ids, counts, sums):
+            rows, total = self.regions.get(int(region), (0, 0.0))
+            self.regions[int(region)] = (rows + int(count), total + region_sums)
+
+    def summary(self, rows, sums):
+        """Gets the rows and each column's MAE, RMSE, and bias from rows and error sums."""
+        error, absolute, squared = sums / max(rows, 1)
+        return dict({"rows": rows}, **{
+            name: {"mae": float(mae), "rmse": float(np.sqrt(mse)), "bias": float(bias)}
+            for name, mae, mse, bias in zip(self.names, absolute, squared, error)
+        })
+
+    def report(self):
+        """Gets the overall and per region summaries as a JSON serialisable dict."""
+        return {
+            "overall": self.summary(self.rows, self.sums),
+            "regions": {
+                str(region): self.summary(rows, sums)
+                for region, (rows, sums) in sorted(self.regions.items())
+            }
+        }
+
+    def write_report(self, path: str):
+        """Writes the report to a JSON file at path."""
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+def evaluate(predict_fn, blocks, metrics=None):
+    """Predicts each (features, targets) block, accumulating the errors into RunningErrors.
+
+    The next block is read in a background thread while the current block is
+    predicted. Time spent predicting and evaluating is recorded in metrics,
+    if given.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    errors = None
+    for features, targets in dataset.prefetched(blocks):
+        if errors is None:
+            names = TARGET_NAMES if targets.shape[1] == len(TARGET_NAMES) else tuple(
+                str(column) for column in range(targets.shape[1])
+            )
+            errors = RunningErrors(names)
+        with metrics.stage("predict"):
+            predictions = predict_fn(features)
+        with metrics.stage("evaluate"):
+            errors.add(predictions, targets, features[:, REGION_COLUMN])
+        metrics.add("rows_evaluated", len(features))
+    return errors if errors is not None else RunningErrors()
+
+def evaluate_split(predict_fn, split="test", directory="output", block_rows=65536,
+                   metrics=None):
+    """Evaluates predictions of a split in the directory, block_rows rows at a time."""
+    return evaluate(predict_fn, dataset.read_blocks(split, directory, block_rows), metrics)
@@ -0,0 +1,83 @@
+"""The metrics module collects stage timings, counters, and throttled progress output
+for the preprocess and predict modules, and writes them out as a JSON report.
+
+Stages may nest, for example HDF reads happen inside subsampling, so stage times
+are not expected to add up to the elapsed time.
+"""
+
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+class Metrics:
+    """Accumulates the time spent in named stages and the totals of named counters.
+
+    Progress messages are printed at most once every progress_interval seconds.
+    """
+
+    def __init__(self, progress_interval=1.0, stream=None):
+        self.started = time.perf_counter()
+        self.stages, self.counters = {}, {}
+        self.progress_interval = progress_interval
+        self.stream = stream
+        self.last_progress = None
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times the enclosed block, adding it to the named stage's seconds and calls."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float, calls=1):
+        """Adds seconds and calls to a named stage."""
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+        stage["seconds"] += seconds
+        stage["calls"] += calls
+
+    def add(self, name: str, amount=1):
+        """Adds an amount to a named counter."""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def elapsed(self):
+        """Gets the seconds since the metrics were created."""
+        return time.perf_counter() - self.started
+
+    def progress(self, message: str, force=False):
+        """Prints a progress message over the last one, unless one was printed too recently."""
+        now = time.perf_counter()
+        due = self.last_progress is None or now - self.last_progress >= self.progress_interval
+        if force or due:
+            self.last_progress = now
+            print(message, end="\r", file=self.stream or sys.stdout, flush=True)
+
+    def merge(self, report):
+        """Adds the stages and counters of another Metrics report, such as a worker's."""
+        for name, stage in report.get("stages", {}).items():
+            self.add_time(name, stage["seconds"], stage["calls"])
+        for name, amount in report.get("counters", {}).items():
+            self.add(name, amount)
+
+    def report(self, rates=()):
+        """Gets the stages, counters, and elapsed time as a JSON serialisable dict.
+
+        Each counter named in rates is also reported per second of elapsed time.
+        """
+        elapsed = self.elapsed()
+        return {
+            "elapsed_seconds": elapsed,
+            "stages": {name: dict(stage) for name, stage in self.stages.items()},
+            "counters": dict(self.counters),
+            "rates": {
+                name + "_per_second": self.counters.get(name, 0) / elapsed if elapsed > 0 else 0.0
+                for name in rates
+            }
+        }
+
+    def write_report(self, path: str, rates=()):
+        """Writes the report to a JSON file at path."""
+        with open(path, "w") as report_file:
+            json.dump(self.report(rates), report_file, indent=2, sort_keys=True)
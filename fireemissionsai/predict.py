@@ -1,23 +1,47 @@
 """The predict module is for taking a .csv of month specific fire emissions features
 and predicting the values for the following month. All the predict.py command requires
-path to such a .csv file.
+path to such a .csv file. The file is read and predicted --chunk-rows rows at a time, with
+each chunk's predictions appended to output/predictions.csv as it completes.
 
 Optionally providing a --retrain parameter will have the predict.py command attempt to
 retrain its model on data in the ouput folder (to get data for training, use the
-preprocess.py module) before predicting values with the new model. If the --persist
+preprocess.py module) before predicting values with the new model. Training data written
+as .npy files is preferred over .csv files and is opened memory-mapped. If the --persist
 parameter is also provided the new learned model and its weights will be persisted for
-future use.
+future use. With --stream the model is trained on shuffled batches streamed from the
+output folder, rather than on the whole training set loaded into memory.
+
+Alternatively --grid and --month forecast the following month for every land cell of a
+GFED4.1s_yyyy.hdf5 file, writing the predicted values as gridded datasets to an HDF5 file.
+Models trained on neighbourhood features need the same --window as the preprocess.py run.
+
+Predictions can be made without Keras or TensorFlow with --engine numpy, which predicts
+with the model exported to model_weights.npz by the engine module, exporting it first if
+there is no such file. --engine-dtype float16 or int8 exports smaller approximate weights.
+
+With --evaluate the test split is streamed from the output folder --chunk-rows rows at a
+time, rather than loaded whole, and the mean absolute error, root mean squared error, and
+bias of each predicted value, overall and per basis region, are written to a JSON report
+instead of printing the predictions. Without --retrain the persisted model is evaluated,
+and inputs may then be omitted.
+
+With --metrics the time spent loading, fitting, and predicting and the rows predicted
+are written to a JSON report.
 """
 
 import os
-import keras
+import h5py
 import numpy as np
-from keras.models import load_model
-from keras.layers import Dense, BatchNormalization
 from argparse import ArgumentParser, RawTextHelpFormatter
 
+from fireemissionsai import dataset, engine, evaluation, preprocess
+from fireemissionsai.metrics import Metrics
+
 def construct_model(input_shape, output_shape):
     """Construct the model for predicting next month's fire emissions data."""
+    # Keras is only imported when needed, as the numpy engine predicts without it.
+    import keras # pylint: disable=import-outside-toplevel
+    from keras.layers import Dense, BatchNormalization # pylint: disable=import-outside-toplevel
     model = keras.models.Sequential()
     model.add(Dense(units=412, activation='relu', input_dim=input_shape))
     model.add(BatchNormalization())
@@ -29,20 +53,155 @@ def construct_model(input_shape, output_shape):
     model.compile(loss='mean_absolute_error', optimizer=sgd, metrics=['accuracy'])
     return model
 
-def train_validate_test_print(model, train_x, train_y, input_x, persist):
-    """Train a provided model on the provided training set."""
-    model.fit(
-        train_x,
-        train_y,
-        epochs=20,
-        validation_data=(
-            np.genfromtxt('output/validation-features.csv', delimiter=','),
-            np.genfromtxt('output/validation-targets.csv', delimiter=',')
+def load_predict_fn(model_path='model_weights.h5', engine_name='keras', dtype='float32'):
+    """Loads the persisted model and returns its predict function.
+
+    With the numpy engine the model's weights are exported next to it as a
+    .npz file of dtype weights, unless already exported since the model was
+    last saved, and predicted with NumPy alone.
+    """
+    if engine_name == 'numpy':
+        weights_path = '{}{}.npz'.format(
+            os.path.splitext(model_path)[0], '' if dtype == 'float32' else '-' + dtype
         )
+        if (not os.path.isfile(weights_path)
+                or os.path.getmtime(weights_path) < os.path.getmtime(model_path)):
+            engine.export(model_path, weights_path, dtype)
+        return engine.load(weights_path).predict
+    from keras.models import load_model # pylint: disable=import-outside-toplevel
+    return load_model(model_path).predict
+
+def split_batches(split, batch_size, buffer_rows=0, seed=None):
+    """Endlessly yields batches of a split streamed from the output folder, an epoch per pass.
+
+    Each pass is shuffled through a buffer of buffer_rows rows, with a new seed
+    derived from seed for every pass, so memory stays bounded by the buffer.
+    """
+    epoch = 0
+    while True:
+        blocks = dataset.read_blocks(split, block_rows=max(batch_size, buffer_rows // 4, 1))
+        pass_seed = None if seed is None else seed + epoch
+        yield from dataset.batches(blocks, batch_size, buffer_rows, pass_seed)
+        epoch += 1
+
+def train_streaming(model, batch_size, buffer_rows, seed=None, epochs=20):
+    """Train a provided model on batches streamed from the training set in the output folder.
+
+    Validation batches are streamed in order from the validation set.
+    """
+    steps = {
+        split: -(-dataset.split_shape(split, 'features')[0] // batch_size)
+        for split in ('train', 'validation')
+    }
+    model.fit_generator(
+        split_batches('train', batch_size, buffer_rows, seed),
+        steps_per_epoch=steps['train'],
+        epochs=epochs,
+        validation_data=split_batches('validation', batch_size),
+        validation_steps=steps['validation']
     )
 
-    test_x = np.genfromtxt('output/test-features.csv', delimiter=',')
-    test_y = np.genfromtxt('output/test-targets.csv', delimiter=',')
+def train_validate_test_print(model, train_x, train_y, inputs_path, persist, metrics=None,
+                              evaluation_path=None, chunk_rows=65536):
+    """Train a provided model on the provided training set."""
+    metrics = metrics if metrics is not None else Metrics()
+    with metrics.stage('fit'):
+        model.fit(
+            train_x,
+            train_y,
+            epochs=20,
+            validation_data=(
+                dataset.load_split('validation', 'features'),
+                dataset.load_split('validation', 'targets')
+            )
+        )
+    test_print(model, inputs_path, persist, metrics, evaluation_path, chunk_rows)
+
+def forecast_grid(predict_fn, gfed_path, month, output_path, chunk_rows=65536, window=1):
+    """Predicts the following month for every land cell of a GFED file into a gridded HDF5 file.
+
+    Feature rows are built from the file's month arrays in memory
+    chunk_rows cells at a time, and each chunk is predicted with the
+    neighbourhood window the model was trained on. The output file has a
+    dataset for each predicted value shaped like lat and lon, which are
+    copied across. Ocean cells are NaN.
+    """
+    with h5py.File(gfed_path, 'r') as hdf:
+        lat, lon = hdf['lat'][()], hdf['lon'][()]
+        grid = np.full((len(preprocess.MONTHLY_DATASETS),) + lat.shape, np.nan, dtype=np.float32)
+        for cells, features in preprocess.grid_feature_blocks(
+                hdf, month, chunk_rows, window=window):
+            grid[:, cells[:, 0], cells[:, 1]] = predict_fn(features).T
+
+    year = int(preprocess.file_year(gfed_path))
+    with h5py.File(output_path, 'w') as output:
+        output.attrs['source'] = os.path.basename(gfed_path)
+        output.attrs['year'] = year + (1 if month == 12 else 0)
+        output.attrs['month'] = month % 12 + 1
+        output['lat'], output['lon'] = lat, lon
+        for name, values in zip(preprocess.MONTHLY_DATASETS, grid):
+            output.create_dataset(
+                name.split('/')[-1], data=values, chunks=True, compression='gzip'
+            )
+
+def predict_csv(predict_fn, input_path, output_path, chunk_rows=65536, metrics=None):
+    """Predicts a .csv of features chunk_rows at a time, appending each chunk to output_path.
+
+    The next chunk is parsed in a background thread while the current chunk is
+    predicted, so memory depends on the chunk size rather than the input size.
+    Time spent predicting and writing is recorded in metrics, if given.
+    Returns the number of rows predicted.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    rows = 0
+    with open(output_path, 'w') as output:
+        for chunk in dataset.prefetched(dataset.csv_blocks(input_path, chunk_rows)):
+            with metrics.stage('predict'):
+                predictions = predict_fn(chunk)
+            with metrics.stage('write'):
+                np.savetxt(output, predictions, delimiter=',')
+                output.flush()
+            rows += len(chunk)
+            metrics.add('rows_predicted', len(chunk))
+    return rows
+
+def evaluate_print(predict_fn, evaluation_path, chunk_rows=65536, metrics=None):
+    """Evaluates predictions of the test split streamed chunk_rows at a time.
+
+    Writes the report of errors per value and region to evaluation_path, and
+    prints the overall errors. Returns the evaluation.RunningErrors.
+    """
+    errors = evaluation.evaluate_split(predict_fn, 'test', block_rows=chunk_rows, metrics=metrics)
+    errors.write_report(evaluation_path)
+    overall = errors.report()['overall']
+    print("\nTest evaluation of {} rows in {} regions:".format(
+        overall['rows'], len(errors.regions)
+    ))
+    for name in errors.names:
+        print("{}: MAE {:.6g}, RMSE {:.6g}, bias {:.6g}".format(
+            name, overall[name]['mae'], overall[name]['rmse'], overall[name]['bias']
+        ))
+    print("Evaluation report saved to " + evaluation_path + ".\n")
+    return errors
+
+def test_print(model, inputs_path, persist, metrics=None, evaluation_path=None,
+               chunk_rows=65536):
+    """Test a trained model, print and save its predictions, and optionally persist it.
+
+    Inputs are predicted chunk_rows at a time. With an evaluation_path the
+    test split is streamed chunk_rows at a time and evaluated into a report
+    instead, and inputs_path may be None to skip predicting inputs.
+    """
+    if evaluation_path is not None:
+        evaluate_print(model.predict, evaluation_path, chunk_rows, metrics)
+        if inputs_path is not None:
+            predict_csv(model.predict, inputs_path, 'output/predictions.csv', chunk_rows, metrics)
+        if persist:
+            model.save('model_weights.h5')
+        return
+
+    test_x = dataset.load_split('test', 'features')
+    test_y = dataset.load_split('test', 'targets')
 
     print("\nTest evaluation: " + str(model.evaluate(test_x, test_y)) + "\n")
 
@@ -56,15 +215,37 @@ def train_validate_test_print(model, train_x, train_y, input_x, persist):
     print(test_y[len(test_y)-3:len(test_y)])
 
     np.savetxt('output/test-predictions.csv', predictions, delimiter=',')
-    np.savetxt('output/predictions.csv', model.predict(input_x), delimiter=',')
+    predict_csv(model.predict, inputs_path, 'output/predictions.csv', chunk_rows, metrics)
     if persist:
         model.save('model_weights.h5')
 
 if __name__ == "__main__":
     PARSER = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
-    PARSER.add_argument("inputs", help="Path to .csv with input features for prediction")
+    PARSER.add_argument("inputs", nargs='?',
+                        help="Path to .csv with input features for prediction")
+    PARSER.add_argument("--grid", help="GFED4.1s_yyyy.hdf5 file to forecast every land cell of")
+    PARSER.add_argument("--month", type=int, help="Month of the --grid file to forecast from")
+    PARSER.add_argument("--window", type=int, help="Neighbourhood width the model was trained on",
+                        default=1)
+    PARSER.add_argument("--grid-output", help="Path of the gridded HDF5 forecast",
+                        default='output/forecast.hdf5')
     PARSER.add_argument("--retrain", dest='retrain', action='store_true', help='Retrain the model')
     PARSER.add_argument("--persist", dest='persist', action='store_true', help='Save retrained model')
+    PARSER.add_argument("--stream", dest='stream', action='store_true',
+                        help='Retrain on batches streamed from the output folder')
+    PARSER.add_argument("--batch-size", type=int, help='Streamed batch size', default=256)
+    PARSER.add_argument("--shuffle-buffer", type=int, help='Rows to shuffle streamed batches in',
+                        default=65536)
+    PARSER.add_argument("--seed", type=int, help='Seed for shuffling streamed batches')
+    PARSER.add_argument("--chunk-rows", type=int, help='Input rows to predict at a time',
+                        default=65536)
+    PARSER.add_argument("--engine", choices=('keras', 'numpy'), default='keras',
+                        help='Predict with Keras, or with NumPy alone from exported weights')
+    PARSER.add_argument("--engine-dtype", choices=engine.DTYPES, default='float32',
+                        help='Type of the weights exported for the numpy engine')
+    PARSER.add_argument("--evaluate", nargs='?', const='output/evaluation.json',
+                        help='Stream the test split, writing errors per region to a JSON report')
+    PARSER.add_argument("--metrics", help='Path to write a JSON report of timings and counters')
     PARSER.add_argument("--debug", dest='debug', action='store_true')
     PARSER.set_defaults(retrain=False)
     PARSER.set_defaults(persist=False)
@@ -73,15 +254,49 @@ if __name__ == "__main__":
 
     if not ARGS.debug:
         os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    METRICS = Metrics()
+
+    if ARGS.grid:
+        if ARGS.month is None:
+            PARSER.error("--month is required with --grid")
+        if not os.path.isdir(os.path.dirname(ARGS.grid_output) or '.'):
+            os.makedirs(os.path.dirname(ARGS.grid_output))
+        with METRICS.stage('load'):
+            PREDICT = load_predict_fn('model_weights.h5', ARGS.engine, ARGS.engine_dtype)
+        with METRICS.stage('predict'):
+            forecast_grid(PREDICT, ARGS.grid, ARGS.month, ARGS.grid_output,
+                          ARGS.chunk_rows, ARGS.window)
+        print('\nGridded forecast saved to ' + ARGS.grid_output + '.\n')
+        if ARGS.metrics:
+            METRICS.write_report(ARGS.metrics)
+        PARSER.exit()
+    if ARGS.inputs is None and ARGS.evaluate is None:
+        PARSER.error("inputs is required unless --grid or --evaluate is given")
 
-    INPUT_X = np.genfromtxt(ARGS.inputs, delimiter=',')
-    if ARGS.retrain:
-        TRAIN_X = np.genfromtxt('output/train-features.csv', delimiter=',')
-        TRAIN_Y = np.genfromtxt('output/train-targets.csv', delimiter=',')
+    if ARGS.retrain and ARGS.stream:
+        MODEL = construct_model(
+            dataset.split_shape('train', 'features')[1], dataset.split_shape('train', 'targets')[1]
+        )
+        with METRICS.stage('fit'):
+            train_streaming(MODEL, ARGS.batch_size, ARGS.shuffle_buffer, ARGS.seed)
+        test_print(MODEL, ARGS.inputs, ARGS.persist, metrics=METRICS,
+                   evaluation_path=ARGS.evaluate, chunk_rows=ARGS.chunk_rows)
+    elif ARGS.retrain:
+        with METRICS.stage('load'):
+            TRAIN_X = dataset.load_split('train', 'features')
+            TRAIN_Y = dataset.load_split('train', 'targets')
 
         MODEL = construct_model(TRAIN_X.shape[1], TRAIN_Y.shape[1])
-        train_validate_test_print(MODEL, TRAIN_X, TRAIN_Y, INPUT_X, ARGS.persist)
+        train_validate_test_print(MODEL, TRAIN_X, TRAIN_Y, ARGS.inputs, ARGS.persist,
+                                  metrics=METRICS, evaluation_path=ARGS.evaluate,
+                                  chunk_rows=ARGS.chunk_rows)
     else:
-        MODEL = load_model('model_weights.h5')
-        np.savetxt('output/predictions.csv', MODEL.predict(INPUT_X), delimiter=',')
-        print('\nPredictions saved to output directory.\n')
+        with METRICS.stage('load'):
+            PREDICT = load_predict_fn('model_weights.h5', ARGS.engine, ARGS.engine_dtype)
+        if ARGS.evaluate is not None:
+            evaluate_print(PREDICT, ARGS.evaluate, ARGS.chunk_rows, METRICS)
+        if ARGS.inputs is not None:
+            predict_csv(PREDICT, ARGS.inputs, 'output/predictions.csv', ARGS.chunk_rows, METRICS)
+            print('\nPredictions saved to output directory.\n')
+    if ARGS.metrics:
+        METRICS.write_report(ARGS.metrics, rates=('rows_predicted', 'rows_evaluated'))
@@ -10,83 +10,481 @@ example data.
 The preprocess module also acts as an importable source of valdation and a
 means of streaming training entries and their target outputs from specified
 valid hdf files.
+
+With --window 5 each entry holds the emissions data of the 5x5 cells around its
+cell, built from strided views over month arrays in memory.
+
+With --stratified entries are sampled from whole column blocks with NumPy masks,
+keeping every positive, where the target burned fraction is not 0, and a seeded
+random --ratio negatives to each, rather than cell by cell.
+
+Progress is checkpointed to output/checkpoint.json as entries are written. A run
+that stopped partway can be continued with --resume, which truncates the output
+to the last checkpoint and carries on from the parser position saved in it.
+--append resumes the same way with a larger size, appending up to --size further
+entries to the existing output. It carries on from wherever the checkpoint
+stopped, so only a run that parsed every file goes on straight to the GFED years
+added to the directory since, while a run stopped earlier by --size carries on
+through the older years first.
+
+With --cache a directory, decoded month datasets are kept there as float32 .npy
+files, up to --cache-size GB, so later runs over the same files read them
+memory-mapped instead of decompressing them again. With a region of interest
+only the rows and columns read of each dataset are cached.
+
+With --prefetch 12 a reader process decodes month datasets into the cache up to
+12 months ahead of the parser, so decompression overlaps with parsing and
+writing. Without --cache a temporary cache directory is used.
+
+A region of interest can be given with --bbox SOUTH NORTH WEST EAST, --regions
+(basis region IDs), --years FIRST LAST, and --months FIRST LAST, in which case
+only the land cells, files, and months inside it are parsed, reading only the
+HDF chunks around those cells. The file of the year after --years is still read
+for the targets of the last year's December.
 """
 
+import io
 import re
 import os
-import csv
+import json
+import time
+import pickle
+import shutil
+import tempfile
+from itertools import chain
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, redirect_stdout
 from argparse import ArgumentParser, RawTextHelpFormatter
 
 import h5py
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from fireemissionsai import dataset
+from fireemissionsai.cache import DEFAULT_MAX_BYTES, SlabCache
+from fireemissionsai.metrics import Metrics
+from fireemissionsai.roi import RegionOfInterest, read_box
+
+# Matches the year and extension of GFED4.1s_yyyy.hdf5 style file names.
+GFED_FILE_REGEX = r'_(\d{4})\.(hdf$|hdf4$|hdf5$|h4$|h5$|he2$|he5$)'
+# Month specific datasets making up the emissions values of an entry, in order.
+MONTHLY_DATASETS = (
+    "biosphere/{:02d}/BB",
+    "biosphere/{:02d}/NPP",
+    "biosphere/{:02d}/Rh",
+    "emissions/{:02d}/C",
+    "emissions/{:02d}/DM",
+    "burned_area/{:02d}/burned_fraction"
+)
+
+def file_year(file_path: str):
+    """Gets the yyyy year string from a GFED file name, or None if it has none."""
+    match = re.search(GFED_FILE_REGEX, file_path, re.IGNORECASE)
+    return match.group(1) if match is not None else None
 
 class GFEDDataParser:
     """Used to create a streamer object that parses groups of valid GFED files.
 
     Outputs entries designed for training a recurrent neural net model.
-    These entries consist of a 5x5 matrix of tuples containing lat long
-    positions and their emissions data, as well as a singular target tuple.
+    These entries consist of the year, month, lat, lon, and region of a cell
+    with its emissions data, as well as a singular target tuple. With a
+    window above 1 the emissions data is that of the window x window cells
+    around the cell, for example 5x5, rather than the cell alone.
     """
 
-    def __init__(self, files):
+    def __init__(self, files, slabs=False, land_cells=None, metrics=None, window=1, cache=None,
+                 prefetch=0, roi=None):
         """files should be a touple of h5py hdf file objects ending _yyyy.hdf5.
 
         This touple of files provided should only include files pre-validated
         by the preprocess validator methods.
+
+        When slabs=True each month dataset is read once as a whole NumPy array
+        and entries are served from memory rather than from per-cell HDF reads.
+        This holds up to a year of month arrays in memory at a time.
+
+        land_cells may be a list holding a land cell index (see build_land_cells)
+        for each file, in which case only those cells are walked.
+
+        HDF read times and bytes are recorded in metrics, a metrics.Metrics.
+
+        window is the odd width of the neighbourhood each entry's emissions
+        data covers, see month_windows. Neighbourhoods are always served
+        from month arrays in memory, as if slabs=True.
+
+        cache may be a cache.SlabCache that month datasets are read from
+        when cached, and saved to when not, in which case whole month arrays
+        are read as if slabs=True.
+
+        With prefetch above 0 a background process reads month datasets into
+        the cache, up to prefetch months ahead of the month being parsed, as
+        if slabs=True. A temporary cache is used if none is given. Call close
+        to stop the process and remove any temporary cache.
+
+        roi may be a roi.RegionOfInterest, in which case only the cells in it
+        are walked, unless land_cells are given, and only months in its month
+        and year ranges are parsed. Only the chunks of rows and columns around those
+        cells are read, into month arrays of zeros, as if slabs=True.
         """
+        if window < 1 or window % 2 == 0:
+            raise ValueError("Neighbourhood window must be odd and positive, not {}".format(window))
         self.files = files
+        self.years = [file_year(hdf.filename) for hdf in files]
         self.max_i, self.max_j = files[0]["ancill/basis_regions"].shape
+        self.window = window
+        self.slabs = slabs or window > 1 or cache is not None or prefetch > 0 or roi is not None
+        self.prefetch = prefetch
+        self._temporary_cache = None
+        if prefetch > 0 and cache is None:
+            self._temporary_cache = tempfile.mkdtemp()
+            cache = SlabCache(self._temporary_cache)
+        self.cache = cache
+        # The reader process and its futures keyed on (file_no, month), for months being read.
+        self._reader, self._reads = None, {}
+        self._signatures = {}
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Decoded month arrays and their neighbourhood views keyed on (file_no, month), and
+        # ancillary arrays keyed on file_no.
+        self._month_slabs, self._month_windows, self._ancillary = {}, {}, {}
+        # Set once next_block has consumed the final column of the final file.
+        self.finished = False
         # The index of the current file being processed.
         self.file_no = 0
         # The current month being processed.
         self.month = 1
         # Current index for looping through lat long matrices.
         self.i, self.j = 0, 0
+        # The inclusive ranges of months and years parsed, and the rows and columns read of
+        # each dataset.
+        self.months, self.year_range, self.box = (1, 12), None, None
+        if roi is not None:
+            if land_cells is None:
+                land_cells = [roi.cells(hdf) for hdf in files]
+            self.months, self.year_range = roi.months, roi.years
+            self.box = read_box(
+                land_cells, (self.max_i, self.max_j),
+                files[0][MONTHLY_DATASETS[0].format(1)].chunks, window // 2
+            )
+        # Per file (i, j) land cell positions in parse order and the current position in them.
+        self.land_cells = land_cells
+        self.cell = 0
+        if land_cells is not None:
+            self.move_to_cell(0)
 
     def current_file(self, next_file=False):
         """Gets the current hdf file or the following file if next=True."""
         return self.files[self.file_no + (1 if next_file else 0)]
 
+    def move_to_cell(self, cell: int):
+        """Moves i and j to a position in the current file's land cell index."""
+        cells = self.land_cells[self.file_no]
+        self.cell = cell
+        self.i, self.j = (int(cells[cell][0]), int(cells[cell][1])) if len(cells) > 0 else (0, 0)
+
+    def read(self, read_values):
+        """Calls read_values to read from HDF files, recording the time and bytes read.
+
+        read_values should return a list of the NumPy arrays read from HDF
+        datasets, such as whole rows rather than values indexed from them, so
+        the bytes counted are those of the selections actually read.
+        """
+        with self.metrics.stage("hdf_read"):
+            values = read_values()
+        self.metrics.add("hdf_bytes_read", sum(value.nbytes for value in values))
+        return values
+
+    def ancillary(self, file_no: int):
+        """Gets the lat, lon, and basis_regions arrays of a file, read once."""
+        if file_no not in self._ancillary:
+            hdf = self.files[file_no]
+            self._ancillary[file_no] = tuple(self.expand(values) for values in self.read(lambda: [
+                self.crop(hdf[name]) for name in ("lat", "lon", "ancill/basis_regions")
+            ]))
+        return self._ancillary[file_no]
+
+    def month_slab(self, file_no: int, month: int):
+        """Gets a (6, max_i, max_j) array of every month dataset in a file.
+
+        The datasets are stacked in MONTHLY_DATASETS order and each is read
+        from the HDF file once. Slabs of files before the current file are
+        discarded as the parser moves on.
+        """
+        key = (file_no, month)
+        if key not in self._month_slabs and self.prefetch > 0:
+            self.wait_for_read(key)
+        if key not in self._month_slabs:
+            self._month_slabs[key] = self.read_month_slab(file_no, month)
+        return self._month_slabs[key]
+
+    def read_month_slab(self, file_no: int, month: int):
+        """Reads the month datasets of a file, from the cache if there is one, and stacks them."""
+        if self.cache is not None:
+            return self.expand(np.stack([
+                self.cached_dataset(file_no, month, name) for name in MONTHLY_DATASETS
+            ]))
+        hdf = self.files[file_no]
+        return self.expand(np.stack(self.read(lambda: [
+            self.crop(hdf[name.format(month)]) for name in MONTHLY_DATASETS
+        ])))
+
+    def crop(self, values):
+        """Reads the region of interest's box of a 2D HDF dataset or array, or all of it."""
+        return values[()] if self.box is None else values[self.box]
+
+    def expand(self, values):
+        """Places arrays read with crop into zeros the shape of the grid, as if read whole.
+
+        Zeros are allocated lazily, so memory scales with the box.
+        """
+        if self.box is None:
+            return values
+        grid = np.zeros(values.shape[:-2] + (self.max_i, self.max_j), dtype=values.dtype)
+        grid[(Ellipsis,) + self.box] = values
+        return grid
+
+    def wait_for_read(self, key):
+        """Waits for the reader process to cache the month of a (file_no, month) key.
+
+        The month and the prefetch months following it are queued to be read,
+        if they have not been already, in file and month order.
+        """
+        if self._reader is None:
+            self._reader = ProcessPoolExecutor(max_workers=1)
+        file_no, month = key
+        for _ in range(self.prefetch + 1):
+            if file_no >= len(self.files):
+                break
+            if (file_no, month) not in self._reads:
+                self._reads[(file_no, month)] = self._reader.submit(
+                    cache_month, self.files[file_no].filename, month, self.cache, self.box
+                )
+            file_no, month = (file_no, month + 1) if month < 12 else (file_no + 1, 1)
+        read = self._reads[key]
+        if read is not None:
+            with self.metrics.stage("prefetch_wait"):
+                self.metrics.merge(read.result())
+            # Reads are waited for once, when their month is first parsed.
+            self._reads[key] = None
+
+    def close(self):
+        """Stops the reader process, if prefetching, and removes any temporary cache."""
+        if self._reader is not None:
+            for read in self._reads.values():
+                if read is not None:
+                    read.cancel()
+            self._reader.shutdown(wait=True)
+            self._reader = None
+        if self._temporary_cache is not None:
+            shutil.rmtree(self._temporary_cache, ignore_errors=True)
+            self._temporary_cache = None
+
+    def cached_dataset(self, file_no: int, month: int, name: str):
+        """Gets a month dataset of a file from the cache, reading and caching it if missing.
+
+        name is one of MONTHLY_DATASETS. Only the region of interest's box of
+        the dataset is read and cached, keyed on the box, as crop reads it.
+        Cache hits and misses are counted in metrics.
+        """
+        if file_no not in self._signatures:
+            self._signatures[file_no] = file_signature(self.files[file_no].filename)
+        variable = name.replace("/{:02d}", "")
+        if self.box is not None:
+            rows, columns = self.box
+            variable = "{}-{}-{}-{}-{}".format(
+                variable, rows.start, rows.stop, columns.start, columns.stop
+            )
+        key = (self.years[file_no], month, variable)
+        source = self._signatures[file_no]
+        with self.metrics.stage("cache_read"):
+            values = self.cache.get(key, source)
+        if values is not None:
+            self.metrics.add("cache_hits")
+            self.metrics.add("cache_bytes_read", values.nbytes)
+            return values
+        self.metrics.add("cache_misses")
+        values = self.read(lambda: [self.crop(self.files[file_no][name.format(month)])])[0]
+        with self.metrics.stage("cache_write"):
+            return self.cache.put(key, source, values)
+
+    def month_windows(self, file_no: int, month: int):
+        """Gets a (6, max_i, max_j, window, window) view of every cell's neighbourhood in a month.
+
+        This is a strided view over the month slab padded by window // 2
+        cells, so no values are copied per cell. Longitude wraps around the
+        grid and beyond the northern and southern edges values are 0.
+        """
+        key = (file_no, month)
+        if key not in self._month_windows:
+            pad = self.window // 2
+            slab = np.pad(self.month_slab(file_no, month), ((0, 0), (0, 0), (pad, pad)), "wrap")
+            slab = np.pad(slab, ((0, 0), (pad, pad), (0, 0)), "constant")
+            rows, columns = slab.shape[1] - 2 * pad, slab.shape[2] - 2 * pad
+            self._month_windows[key] = as_strided(
+                slab, shape=slab.shape[:1] + (rows, columns, self.window, self.window),
+                strides=slab.strides + slab.strides[1:], writeable=False
+            )
+        return self._month_windows[key]
+
+    def discard_slabs(self):
+        """Drops cached arrays belonging to files before the current file."""
+        self._month_slabs = {
+            key: slab for key, slab in self._month_slabs.items() if key[0] >= self.file_no
+        }
+        self._month_windows = {
+            key: view for key, view in self._month_windows.items() if key[0] >= self.file_no
+        }
+        self._ancillary = {
+            key: arrays for key, arrays in self._ancillary.items() if key >= self.file_no
+        }
+
+    def region(self, i: int, j: int):
+        """Gets the basis region ID at position i,j in the current file."""
+        if self.slabs:
+            return self.ancillary(self.file_no)[2][i, j]
+        return self.read(lambda: [self.current_file()["ancill/basis_regions"][i]])[0][j]
+
+    def on_land(self):
+        """Checks the current cell is on land, without a lookup when walking land cells."""
+        return self.land_cells is not None or self.region(self.i, self.j) != 0
+
     def get_entry(self, i: int, j: int):
         """Gets an entry from position i,j in current file."""
+        if self.slabs:
+            lat, lon, regions = self.ancillary(self.file_no)
+            if self.window > 1:
+                values = self.month_windows(self.file_no, self.month)[:, i, j].ravel()
+            else:
+                values = self.month_slab(self.file_no, self.month)[:, i, j]
+            return [
+                self.years[self.file_no], self.month, lat[i, j], lon[i, j], regions[i, j]
+            ] + list(values)
         hdf = self.current_file()
-        name = hdf.filename
-        regex_string = r'_(\d{4})\.(hdf$|hdf4$|hdf5$|h4$|h5$|he2$|he5$)'
-        search = re.search(regex_string, name, re.IGNORECASE)
-        return [
-            search.group(1), # Year
-            self.month,
-            hdf["lat"][i][j],
-            hdf["lon"][i][j],
-            hdf["ancill/basis_regions"][i][j],
-            hdf["biosphere/{:02d}/BB".format(self.month)][i][j],
-            hdf["biosphere/{:02d}/NPP".format(self.month)][i][j],
-            hdf["biosphere/{:02d}/Rh".format(self.month)][i][j],
-            hdf["emissions/{:02d}/C".format(self.month)][i][j],
-            hdf["emissions/{:02d}/DM".format(self.month)][i][j],
-            hdf["burned_area/{:02d}/burned_fraction".format(self.month)][i][j]
-        ]
+        rows = self.read(lambda: [
+            hdf["lat"][i],
+            hdf["lon"][i],
+            hdf["ancill/basis_regions"][i]
+        ] + [hdf[name.format(self.month)][i] for name in MONTHLY_DATASETS])
+        return [self.years[self.file_no], self.month] + [row[j] for row in rows]
 
     def get_target(self, i: int, j: int):
         """Gets an entry from position i,j in file f+plus in files."""
         if self.has_next_month() or self.has_next_file():
             target_month = self.month + 1 if self.has_next_month() else 1
-            hdf = self.current_file() if target_month > 1 else self.current_file(next_file=True)
-            return [
-                hdf["biosphere/{:02d}/BB".format(target_month)][i][j],
-                hdf["biosphere/{:02d}/NPP".format(target_month)][i][j],
-                hdf["biosphere/{:02d}/Rh".format(target_month)][i][j],
-                hdf["emissions/{:02d}/C".format(target_month)][i][j],
-                hdf["emissions/{:02d}/DM".format(target_month)][i][j],
-                hdf["burned_area/{:02d}/burned_fraction".format(target_month)][i][j]
-            ]
+            file_no = self.file_no + (0 if target_month > 1 else 1)
+            if self.slabs:
+                return list(self.month_slab(file_no, target_month)[:, i, j])
+            hdf = self.files[file_no]
+            rows = self.read(
+                lambda: [hdf[name.format(target_month)][i] for name in MONTHLY_DATASETS]
+            )
+            return [row[j] for row in rows]
         return []
 
+    def next_block(self):
+        """Parses the rest of the current column j as feature and target arrays.
+
+        Rows are in the same order as repeated calls to next() would give them,
+        starting from the current month and i. Rows that have no target (the
+        last file's Decembers) are left out, as are rows of cells outside the
+        land cell index being walked, if any, and of months and years outside
+        the ranges parsed. The parser then moves on to the start of the next
+        column, or of the next file.
+        """
+        file_no, j = self.file_no, self.j
+        lat, lon, regions = self.ancillary(file_no)
+        # Shape (max_i, 12, 6); every month of every cell in column j.
+        values = np.stack(
+            [self.month_slab(file_no, month)[:, :, j] for month in range(1, 13)], axis=1
+        ).T
+        targets = values[:, 1:]
+        if self.has_next_file():
+            following = self.month_slab(file_no + 1, 1)[:, :, j].T[:, np.newaxis]
+            targets = np.concatenate([targets, following], axis=1)
+        months = targets.shape[1]
+
+        if self.window > 1:
+            # Shape (max_i, months, 6 * window * window); each cell's neighbourhoods by month.
+            values = np.stack(
+                [self.month_windows(file_no, month)[:, :, j] for month in range(1, months + 1)],
+                axis=1
+            ).transpose(2, 1, 0, 3, 4).reshape(self.max_i, months, -1)
+        features = np.empty(values.shape[:1] + (months, 5 + values.shape[2]), dtype=values.dtype)
+        features[:, :, 0] = float(self.years[file_no])
+        features[:, :, 1] = np.arange(1, months + 1)
+        features[:, :, 2] = lat[:, j, np.newaxis]
+        features[:, :, 3] = lon[:, j, np.newaxis]
+        features[:, :, 4] = regions[:, j, np.newaxis]
+        features[:, :, 5:] = values[:, :months]
+
+        start = self.i * months + min(self.month - 1, months)
+        block = (
+            features.reshape(-1, features.shape[2])[start:],
+            targets.reshape(-1, targets.shape[2])[start:]
+        )
+        keep = None
+        if self.land_cells is not None:
+            cells = self.land_cells[file_no]
+            walked = np.zeros(self.max_i, dtype=bool)
+            first, last = np.searchsorted(cells[:, 1], [j, j + 1])
+            walked[cells[first:last, 0]] = True
+            keep = np.repeat(walked, months)[start:]
+        if not self.in_years():
+            keep = np.zeros(len(block[0]), dtype=bool)
+        elif self.months != (1, 12):
+            month_rows = block[0][:, 1]
+            in_months = (month_rows >= self.months[0]) & (month_rows <= self.months[1])
+            keep = in_months if keep is None else keep & in_months
+        if keep is not None:
+            block = tuple(rows[keep] for rows in block)
+
+        if self.land_cells is not None:
+            following = np.searchsorted(self.land_cells[file_no][:, 1], j, side='right')
+            if following < len(self.land_cells[file_no]):
+                self.reset()
+                self.move_to_cell(following)
+            elif self.has_next_file():
+                self.reset()
+                self.file_no += 1
+                self.discard_slabs()
+                self.move_to_cell(0)
+            else:
+                self.finished = True
+            return block
+
+        if self.j < (self.max_j - 1):
+            self.reset(i_b=True)
+            self.j += 1
+        elif self.has_next_file():
+            self.reset(i_b=True, j_b=True)
+            self.file_no += 1
+            self.discard_slabs()
+        else:
+            self.finished = True
+        return block
+
+    def has_next_block(self):
+        """Checks whether next_block has any columns left to parse."""
+        return not self.finished
+
     def has_next_month(self):
         """Checks whether there is another month in the current file."""
         return self.month < 12
 
+    def in_years(self):
+        """Checks whether the current file's year is within the range of years parsed."""
+        if self.year_range is None:
+            return True
+        return self.year_range[0] <= int(self.years[self.file_no]) <= self.year_range[1]
+
+    def in_range(self):
+        """Checks whether the current month and year are within the ranges parsed."""
+        return self.in_years() and self.months[0] <= self.month <= self.months[1]
+
     def has_next_coordinate(self):
         """Checks whether there is another coordinate in the current file."""
+        if self.land_cells is not None:
+            return self.cell < (len(self.land_cells[self.file_no]) - 1)
         return self.i < (self.max_i - 1) or self.j < (self.max_j - 1)
 
     def has_next_file(self):
@@ -97,6 +495,22 @@ class GFEDDataParser:
         """Checks whether there is another entry to parse."""
         return self.has_next_month() or self.has_next_coordinate() or self.has_next_file()
 
+    def state(self):
+        """Gets the parser's position as a JSON serialisable dict, see restore."""
+        return {
+            "file_no": self.file_no, "month": self.month, "i": self.i, "j": self.j,
+            "cell": self.cell
+        }
+
+    def restore(self, state):
+        """Moves the parser to a position given by state."""
+        self.file_no, self.month = state["file_no"], state["month"]
+        self.i, self.j = state["i"], state["j"]
+        self.finished = False
+        if self.land_cells is not None:
+            self.move_to_cell(state["cell"])
+        self.discard_slabs()
+
     def next(self):
         """Parses and converts the next training example."""
         training = self.get_entry(self.i, self.j)
@@ -118,6 +532,16 @@ class GFEDDataParser:
         if self.has_next_month():
             self.month += 1
             return
+        if self.land_cells is not None:
+            if self.has_next_coordinate():
+                self.reset()
+                self.move_to_cell(self.cell + 1)
+            elif self.has_next_file():
+                self.reset()
+                self.file_no += 1
+                self.discard_slabs()
+                self.move_to_cell(0)
+            return
         if self.i < (self.max_i - 1):
             self.reset()
             self.i += 1
@@ -129,14 +553,111 @@ class GFEDDataParser:
         if self.has_next_file():
             self.reset(i_b=True, j_b=True)
             self.file_no += 1
+            self.discard_slabs()
         return
 
 
+def cache_month(path: str, month: int, cache, box=None):
+    """Reads a month's datasets of a GFED file into a cache.SlabCache, if not cached already.
+
+    This is run in the reader process of a prefetching GFEDDataParser. Only
+    the (row slice, column slice) box of each dataset is read, if given.
+    Returns the process's metrics report of the reads.
+    """
+    metrics = Metrics()
+    with h5py.File(path, "r") as hdf:
+        parser = GFEDDataParser([hdf], metrics=metrics, cache=cache)
+        parser.box = box
+        for name in MONTHLY_DATASETS:
+            parser.cached_dataset(0, month, name)
+    return metrics.report()
+
+def build_land_cells(hdf: h5py.File):
+    """Builds an (n, 2) array of the i, j positions of every land cell in a file.
+
+    Land cells are those with a non-zero basis region. Positions are ordered
+    as the parser visits them, by column j and then by row i.
+    """
+    j, i = np.nonzero(hdf["ancill/basis_regions"][()].T)
+    return np.stack([i, j], axis=1)
+
+def grid_features(hdf: h5py.File, month: int, land_cells=None, window=1):
+    """Builds the features of every land cell in one month of a file, from whole arrays.
+
+    Rows are as get_entry would give them with the neighbourhood window, in
+    the order of land_cells, which is built from the file if not given.
+    Returns the (n, 2) land cell positions and the (n, 5 + 6 * window ** 2)
+    feature rows.
+    """
+    if land_cells is None:
+        land_cells = build_land_cells(hdf)
+    blocks = list(grid_feature_blocks(hdf, month, max(len(land_cells), 1), land_cells, window))
+    if len(blocks) == 0:
+        return land_cells, np.empty((0, 5 + 6 * window ** 2), dtype=np.float32)
+    return blocks[0]
+
+def grid_feature_blocks(hdf: h5py.File, month: int, block_rows=65536, land_cells=None,
+                        window=1):
+    """Yields the land cell positions and features of grid_features block_rows cells at a time.
+
+    The month's datasets are read once, while feature rows are only built
+    for one block of cells at a time.
+    """
+    parser = GFEDDataParser([hdf], slabs=True, window=window)
+    lat, lon, regions = parser.ancillary(0)
+    if land_cells is None:
+        land_cells = build_land_cells(hdf)
+    for start in range(0, len(land_cells), block_rows):
+        cells = land_cells[start:start + block_rows]
+        i, j = cells[:, 0], cells[:, 1]
+        if window > 1:
+            values = parser.month_windows(0, month)[:, i, j].transpose(1, 0, 2, 3)
+        else:
+            values = parser.month_slab(0, month)[:, i, j].T
+        values = values.reshape(len(cells), -1)
+        features = np.empty((len(cells), 5 + values.shape[1]), dtype=values.dtype)
+        features[:, 0] = float(parser.years[0])
+        features[:, 1] = month
+        features[:, 2] = lat[i, j]
+        features[:, 3] = lon[i, j]
+        features[:, 4] = regions[i, j]
+        features[:, 5:] = values
+        yield cells, features
+
+def load_land_cells(files, index_path=None):
+    """Gets the land cell index for each file, reusing any saved in index_path.
+
+    Saved indices are keyed on file name, size, and modification time in an
+    .npz archive, so the index of a file replaced under the same name is
+    rebuilt. If index_path is given, indices missing from it are built and
+    the archive is (re)written, dropping those of replaced files.
+    """
+    saved = {}
+    if index_path is not None and os.path.isfile(index_path):
+        with np.load(index_path) as archive:
+            saved = dict(archive)
+    names = []
+    for hdf in files:
+        signature = file_signature(hdf.filename)
+        names.append("{}-{}-{}".format(
+            os.path.basename(hdf.filename), signature["size"], signature["mtime_ns"]
+        ))
+    missing = [name for name in names if name not in saved]
+    for name, hdf in zip(names, files):
+        if name in missing:
+            prefix = os.path.basename(hdf.filename) + "-"
+            saved = {key: cells for key, cells in saved.items() if not key.startswith(prefix)}
+            saved[name] = build_land_cells(hdf)
+    if index_path is not None and len(missing) > 0:
+        directory = os.path.dirname(index_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.savez(index_path, **saved)
+    return [saved[name] for name in names]
+
 def valid_hdf_file(file_path: str):
     """Returns true if this file exists and has the correct extension."""
-    regex_string = r'_(\d{4})\.(hdf$|hdf4$|hdf5$|h4$|h5$|he2$|he5$)'
-    match = re.search(regex_string, file_path, re.IGNORECASE)
-    if os.path.isfile(file_path) and match != None:
+    if os.path.isfile(file_path) and file_year(file_path) is not None:
         return True
     return False
 
@@ -166,41 +687,111 @@ def valid_hdf_structure(file_path: str):
     Prints errors to the console if expected groups cannot be found.
     Returns true if all expected groups are present, otherwise false.
     """
-    hdf = h5py.File(file_path, 'r')
-    valid = True
-    expected_message = "Expected group '{}' not in HDF file '{}'"
-    for group in "ancill/basis_regions", "lon", "lat":
-        if group not in hdf:
-            valid = False
-            print(expected_message.format(group, hdf.filename))
-    for group in "biosphere", "burned_area", "emissions":
-        for month in range(1, 13):
-            full_group = "{}/{:02d}".format(group, month)
-            if full_group not in hdf:
+    with h5py.File(file_path, 'r') as hdf:
+        valid = True
+        expected_message = "Expected group '{}' not in HDF file '{}'"
+        for group in "ancill/basis_regions", "lon", "lat":
+            if group not in hdf:
                 valid = False
-                print(expected_message.format(full_group, hdf.filename))
-            else:
-                valid = valid and valid_leaf_groups(group, month, hdf)
+                print(expected_message.format(group, hdf.filename))
+        for group in "biosphere", "burned_area", "emissions":
+            for month in range(1, 13):
+                full_group = "{}/{:02d}".format(group, month)
+                if full_group not in hdf:
+                    valid = False
+                    print(expected_message.format(full_group, hdf.filename))
+                else:
+                    valid = valid and valid_leaf_groups(group, month, hdf)
     return valid
 
-def valid_files(directory):
-    """Collects and returns all valid files in the provided directory."""
+def file_signature(file_path: str):
+    """Gets the size and modification time a file's cached validation result is keyed on."""
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def check_hdf_structure(file_path: str):
+    """Runs valid_hdf_structure, returning its result along with anything it printed.
+
+    This lets files be checked in worker processes and their errors printed in order.
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        valid = valid_hdf_structure(file_path)
+    return valid, output.getvalue()
+
+def validate_structures(paths, manifest_path=None, workers=1):
+    """Checks the structure of each path, reusing results cached in a manifest.
+
+    The manifest is a JSON file mapping absolute paths to their signature and
+    validation result. Files whose size and modification time are unchanged
+    are not opened again. Other files are checked, in a process pool when
+    workers is above 1, and the manifest is updated. Returns a list of
+    results in the order of paths.
+    """
+    manifest = {}
+    if manifest_path is not None and os.path.isfile(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    keys = [os.path.abspath(path) for path in paths]
+    signatures = [file_signature(path) for path in paths]
+    unchecked = [
+        index for index, (key, signature) in enumerate(zip(keys, signatures))
+        if key not in manifest or manifest[key]["signature"] != signature
+    ]
+
+    if workers > 1 and len(unchecked) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            checks = list(executor.map(check_hdf_structure, [paths[index] for index in unchecked]))
+    else:
+        checks = [check_hdf_structure(paths[index]) for index in unchecked]
+    for index, (valid, output) in zip(unchecked, checks):
+        print(output, end="")
+        manifest[keys[index]] = {"signature": signatures[index], "valid": valid}
+
+    if manifest_path is not None and len(unchecked) > 0:
+        directory = os.path.dirname(manifest_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    return [manifest[key]["valid"] for key in keys]
+
+def valid_files(directory, manifest_path=None, workers=1):
+    """Collects and returns all valid files in the provided directory.
+
+    See validate_structures for how manifest_path and workers are used.
+    """
+    paths = [
+        directory + file_name for file_name in sorted(os.listdir(directory))
+        if valid_hdf_file(directory + file_name)
+    ]
     files = []
-    for file_name in sorted(os.listdir(directory)):
-        full_path = directory + file_name
-        if valid_hdf_file(full_path) and valid_hdf_structure(full_path):
-            files.append(h5py.File(full_path, 'r'))
-            print("  " + file_name)
+    for path, valid in zip(paths, validate_structures(paths, manifest_path, workers)):
+        if valid:
+            files.append(h5py.File(path, 'r'))
+            print("  " + os.path.basename(path))
     return files
 
 def get_subsample(parser, ratio):
-    """Gets subsample of training data with a minimum ratio of negative to positive."""
+    """Gets subsample of training data with a minimum ratio of negative to positive.
+
+    Parsing stops on a December of the last file, which has no target, when
+    there are no entries left to return. The parser is left on that December
+    so a run resumed with a following year's file carries on from it. Other
+    months outside the parser's ranges of months and years are skipped.
+    """
     entries = []
     while parser.has_next():
-        if parser.current_file()["ancill/basis_regions"][parser.i][parser.j] != 0:
-            features, targets = parser.next()
-            if len(targets) == 0:
+        if parser.on_land():
+            if not parser.has_next_month() and not parser.has_next_file():
+                if len(entries) > 0:
+                    parser.increment()
                 break
+            if not parser.in_range():
+                parser.increment()
+                continue
+            features, targets = parser.next()
+            parser.metrics.add("cells_visited")
             if targets[len(targets) - 1] == 0:
                 entries.append([features, targets])
                 if ratio > 0:
@@ -212,56 +803,524 @@ def get_subsample(parser, ratio):
                 entries.append([features, targets])
                 return entries
         else:
+            parser.metrics.add("ocean_cells_skipped")
             parser.increment()
 
     return entries
 
-def validate_and_parse(directory, size, ratio):
-    """Validates the files in a directory for GFED format and parses them."""
+def subsamples(parser, ratio):
+    """Yields each subsample from get_subsample until an empty one is returned."""
+    entries = get_subsample(parser, ratio)
+    while len(entries) != 0:
+        yield entries
+        entries = get_subsample(parser, ratio)
+
+def subsample_states(parser, ratio):
+    """Yields (entries, state) pairs of each subsample and the parser state following it.
+
+    A final empty subsample is yielded with the state parsing stopped at.
+    """
+    for entries in subsamples(parser, ratio):
+        yield entries, parser.state()
+    yield [], parser.state()
+
+def sample_block(features, targets, ratio, rng):
+    """Samples the land rows of a block with at most ratio negatives to each positive.
+
+    Positives are rows whose target burned fraction is not 0 and are all
+    kept. ratio * positives negatives are picked uniformly at random, by
+    keeping those with the smallest random keys drawn from rng, a NumPy
+    RandomState, so the sample is reproducible. Rows keep their order. If
+    ratio is not above 0 every land row is kept.
+    """
+    land = features[:, 4] != 0
+    if ratio <= 0:
+        return features[land], targets[land]
+    keep = land & (targets[:, -1] != 0)
+    negatives = np.flatnonzero(land & ~keep)
+    picks = min(len(negatives), ratio * np.count_nonzero(keep))
+    if picks > 0:
+        keys = rng.random_sample(len(negatives))
+        keep[negatives[np.argpartition(keys, picks - 1)[:picks]]] = True
+    return features[keep], targets[keep]
+
+def sampled_blocks(parser, ratio, seed=0):
+    """Yields (features, targets, state) for each column block sampled with sample_block.
+
+    Each block is sampled with a RandomState seeded on seed, the file's year,
+    and the column, so samples do not depend on where parsing started.
+    state is the parser state following the block. The last file only
+    supplies the previous file's December targets, so parsing stops at its
+    start, where a run resumed with a following year's file carries on from.
+    """
+    while parser.has_next_block() and parser.has_next_file():
+        rng = np.random.RandomState([seed, int(parser.years[parser.file_no]), parser.j])
+        features, targets = parser.next_block()
+        parser.metrics.add("cells_visited", len(features))
+        with parser.metrics.stage("sample"):
+            features, targets = sample_block(features, targets, ratio, rng)
+        yield features, targets, parser.state()
+
+def shard_segments(parser, ratio, size, file_no=0):
+    """Gets the subsample segments of the first file a parser walks through.
+
+    This follows get_subsample entry by entry but stops at the end of the
+    first file, so each file can be parsed on its own. Segments are tuples of
+    (kind, negatives, positive, state) where kind is 'positive' for a positive
+    entry and the negatives kept before it, 'emit' for a lone negative (when
+    ratio is not above 0), 'flush' when the negatives are returned without a
+    positive, and 'carry' for negatives still pending at the end of a file
+    that has a following file. A 'stop' segment holds the negatives pending
+    on a December of the last file, where parsing stops if there are none.
+    state is the parser state following the segment, with file numbers
+    offset by file_no, the position of the first file among all files.
+    Parsing stops early once the segments hold size entries, as no more
+    could be written.
+    """
+    segments, negatives, emitted = [], deque(maxlen=max(ratio, 1)), 0
+    end_kind = "carry" if parser.has_next_file() else "flush"
+
+    def state():
+        return dict(parser.state(), file_no=parser.file_no + file_no)
+
+    while parser.has_next() and parser.file_no == 0 and emitted < size:
+        if not parser.on_land():
+            parser.metrics.add("ocean_cells_skipped")
+            parser.increment()
+            continue
+        if not parser.has_next_month() and not parser.has_next_file():
+            segments.append(("stop", list(negatives), None, state()))
+            emitted += len(negatives)
+            negatives.clear()
+            parser.increment()
+            segments.append(("flush", [], None, state()))
+            continue
+        if not parser.in_range():
+            parser.increment()
+            continue
+        features, targets = parser.next()
+        parser.metrics.add("cells_visited")
+        if targets[len(targets) - 1] != 0:
+            segments.append(("positive", list(negatives), [features, targets], state()))
+            emitted += len(negatives) + 1
+            negatives.clear()
+        elif ratio > 0:
+            negatives.append([features, targets])
+        else:
+            segments.append(("emit", [[features, targets]], None, state()))
+            emitted += 1
+    segments.append((end_kind, list(negatives), None, state()))
+    return segments
+
+def parse_shard(paths, land_cells, ratio, size, shard_path, *, slabs=False, file_no=0,
+                start=None, window=1, cache=None, roi=None):
+    """Parses the first of one or two GFED files and pickles its segments to shard_path.
+
+    The second file, if given, only supplies targets for the first file's
+    Decembers. file_no is the position of the first file among all files,
+    and start a parser state within it to begin from. This is run in worker
+    processes by parse_in_parallel. Returns the shard path and the worker's
+    metrics report.
+    """
+    metrics = Metrics()
+    files = [h5py.File(path, 'r') for path in paths]
+    try:
+        parser = GFEDDataParser(
+            files, slabs=slabs, land_cells=land_cells, metrics=metrics, window=window, cache=cache,
+            roi=roi
+        )
+        if start is not None:
+            parser.restore(dict(start, file_no=0))
+        segments = shard_segments(parser, ratio, size, file_no)
+    finally:
+        for hdf in files:
+            hdf.close()
+    with open(shard_path, "wb") as shard:
+        pickle.dump(segments, shard, pickle.HIGHEST_PROTOCOL)
+    return shard_path, metrics.report()
+
+def merge_shards(shards, ratio):
+    """Yields the (entries, state) pairs subsample_states would give from consecutive shards.
+
+    Negatives carried over from the end of one file are joined with those at
+    the start of the next. As with subsample_states, iteration ends with an
+    empty subsample and the state parsing stopped at.
+    """
+    carry = []
+    for segments in shards:
+        for kind, negatives, positive, state in segments:
+            if len(carry) > 0:
+                negatives = (carry + negatives)[-ratio:]
+                carry = []
+            if kind == "carry" or (kind == "stop" and len(negatives) > 0):
+                carry = negatives
+                continue
+            entries = negatives + ([positive] if positive is not None else [])
+            if len(entries) == 0:
+                yield [], state
+                return
+            yield entries, state
+
+def parse_in_parallel(files, ratio, size, workers, *, slabs=False, land_cells=None,
+                      metrics=None, start=None, window=1, cache=None, roi=None):
+    """Yields the same pairs as subsample_states() by parsing each year in a process pool.
+
+    Each worker parses one file, with the following file for December
+    targets, into a shard in output/shards. Shards are merged in file order
+    as they complete and removed once read. Worker metrics are merged into
+    metrics, if given. Parsing begins from the parser state start, if given.
+    Workers share the cache, a cache.SlabCache, if given, and parse only the
+    region of interest roi, if given.
+    """
+    first = start["file_no"] if start is not None else 0
+    shard_directory = os.path.join("output", "shards")
+    if not os.path.isdir(shard_directory):
+        os.makedirs(shard_directory)
+    paths = [hdf.filename for hdf in files]
+    shard_paths = [
+        os.path.join(shard_directory, "shard-{:04d}.pickle".format(file_no))
+        for file_no in range(first, len(paths))
+    ]
+
+    def load_shards(futures):
+        for future in futures:
+            shard_path, report = future.result()
+            with open(shard_path, "rb") as shard:
+                segments = pickle.load(shard)
+            os.remove(shard_path)
+            if metrics is not None:
+                metrics.merge(report)
+            yield segments
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    parse_shard,
+                    paths[file_no:file_no + 2],
+                    None if land_cells is None else land_cells[file_no:file_no + 2],
+                    ratio,
+                    size,
+                    shard_path,
+                    slabs=slabs,
+                    file_no=file_no,
+                    start=start if file_no == first else None,
+                    window=window,
+                    cache=cache,
+                    roi=roi
+                )
+                for file_no, shard_path in enumerate(shard_paths, first)
+            ]
+            try:
+                yield from merge_shards(load_shards(futures), ratio)
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        # Shards left unread when the merge stopped early.
+        for shard_path in shard_paths:
+            if os.path.isfile(shard_path):
+                os.remove(shard_path)
+
+def entry_split(count: int):
+    """Gets the split an entry is written to from its 1-based position in the output."""
+    if (count % 10) == 0:
+        return "validation"
+    if (count % 25) == 0:
+        return "test"
+    return "train"
+
+class Checkpoint:
+    """The progress of a preprocessing run, saved as JSON so the run can be resumed.
+
+    This holds the names of the files parsed and the options that change the
+    output, the parser state following the last subsample written, the number
+    of entries written, which decides the split of the next entry, and the
+    state of each split file's writer. Entries of the last subsample that
+    were not written, as the size was reached, are kept as pending.
+    """
+
+    def __init__(self, path, files, options, interval=30.0):
+        self.path = path
+        self.files = [os.path.basename(hdf.filename) for hdf in files]
+        self.options = options
+        self.interval = interval
+        self.count, self.state, self.pending, self.writers = 0, None, [], None
+        self.saved = time.perf_counter()
+
+    def due(self):
+        """Checks whether interval seconds have passed since the checkpoint was last saved."""
+        return time.perf_counter() - self.saved >= self.interval
+
+    def save(self, writers, count, state, pending=()):
+        """Saves the checkpoint after count entries with the writers' current states.
+
+        pending entries are saved as strings, which are written out unchanged.
+        """
+        self.count, self.state = count, state
+        self.pending = [[[str(value) for value in values] for values in entry] for entry in pending]
+        self.writers = dataset.writer_states(writers)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + ".tmp", "w") as checkpoint_file:
+            json.dump({
+                "files": self.files, "options": self.options, "count": self.count,
+                "state": self.state, "pending": self.pending, "writers": self.writers
+            }, checkpoint_file, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+        self.saved = time.perf_counter()
+
+def load_checkpoint(path, files, options, interval=30.0):
+    """Loads the checkpoint saved at path, for resuming a run over files with options.
+
+    Raises a ValueError if the checkpoint was saved with different options or
+    its files are not the first of files, as new files may only be added after
+    those already parsed.
+    """
+    checkpoint = Checkpoint(path, files, options, interval)
+    with open(path) as checkpoint_file:
+        saved = json.load(checkpoint_file)
+    if saved["options"] != options:
+        raise ValueError("Checkpoint '{}' was saved with options {} but resuming with {}".format(
+            path, saved["options"], options
+        ))
+    if saved["files"] != checkpoint.files[:len(saved["files"])]:
+        raise ValueError("Checkpoint '{}' files {} are not the first of {}".format(
+            path, saved["files"], checkpoint.files
+        ))
+    checkpoint.count, checkpoint.state = saved["count"], saved["state"]
+    checkpoint.pending, checkpoint.writers = saved["pending"], saved["writers"]
+    return checkpoint
+
+def entry_split_masks(positions):
+    """Gets a mask of the 1-based output positions written to each split, as entry_split."""
+    validation = (positions % 10) == 0
+    test = ~validation & ((positions % 25) == 0)
+    return {"train": ~(validation | test), "validation": validation, "test": test}
+
+def write_entries(writers, entry_subsamples, size, metrics=None, checkpoint=None):
+    """Writes entries from an iterable of subsamples to their splits, up to size entries.
+
+    writers maps each split name to a (features, targets) pair of row writers.
+    entry_subsamples yields (entries, state) pairs, as from subsample_states.
+    Time spent subsampling and writing, and the entries written, are recorded
+    in metrics. If a Checkpoint is given counting continues from its count,
+    and it is saved every interval and once the entries are written. Returns
+    the total number of entries written.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    count = checkpoint.count if checkpoint is not None else 0
+    state = checkpoint.state if checkpoint is not None else None
+    pending = []
+    entry_subsamples = iter(entry_subsamples)
+    while count < size:
+        with metrics.stage("subsample"):
+            entries, state = next(entry_subsamples, ([], state))
+        if len(entries) == 0:
+            break
+        written = count
+        with metrics.stage("write"):
+            for index, entry in enumerate(entries):
+                count += 1
+                features_writer, targets_writer = writers[entry_split(count)]
+                features_writer.writerow(entry[0])
+                targets_writer.writerow(entry[1])
+                if count >= size:
+                    pending = entries[index + 1:]
+                    break
+        metrics.add("entries", count - written)
+        metrics.progress("Entries found: {} ({:.0f}/s)".format(
+            count, count / max(metrics.elapsed(), 1e-9)
+        ))
+        if checkpoint is not None and checkpoint.due():
+            with metrics.stage("checkpoint"):
+                checkpoint.save(writers, count, state)
+    if checkpoint is not None:
+        with metrics.stage("checkpoint"):
+            checkpoint.save(writers, count, state, pending)
+    return count
+
+def write_blocks(writers, blocks, size, metrics=None, checkpoint=None):
+    """Writes the rows of an iterable of blocks to their splits, up to size entries.
+
+    blocks yields (features, targets, state) tuples, as from sampled_blocks,
+    and each block is written to the splits with one call per split file.
+    Metrics and checkpoints are as for write_entries. Returns the total number
+    of entries written.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    count = checkpoint.count if checkpoint is not None else 0
+    state = checkpoint.state if checkpoint is not None else None
+    pending = []
+    blocks = iter(blocks)
+    while count < size:
+        with metrics.stage("subsample"):
+            features, targets, state = next(blocks, (None, None, state))
+        if features is None:
+            break
+        rows = min(len(features), size - count)
+        with metrics.stage("write"):
+            masks = entry_split_masks(np.arange(count + 1, count + rows + 1))
+            for split, mask in masks.items():
+                features_writer, targets_writer = writers[split]
+                features_writer.writerows(features[:rows][mask])
+                targets_writer.writerows(targets[:rows][mask])
+        pending = list(zip(features[rows:], targets[rows:]))
+        count += rows
+        metrics.add("entries", rows)
+        metrics.progress("Entries found: {} ({:.0f}/s)".format(
+            count, count / max(metrics.elapsed(), 1e-9)
+        ))
+        if checkpoint is not None and checkpoint.due():
+            with metrics.stage("checkpoint"):
+                checkpoint.save(writers, count, state)
+    if checkpoint is not None:
+        with metrics.stage("checkpoint"):
+            checkpoint.save(writers, count, state, pending)
+    return count
+
+def validate_and_parse(directory, size, ratio, *, slabs=False, land_index=None, workers=1,
+                       file_format="csv", manifest=None, metrics_path=None,
+                       checkpoint_path=None, resume=False, append=False, window=1,
+                       stratified=False, seed=0, cache_directory=None,
+                       cache_size=DEFAULT_MAX_BYTES, prefetch=0, roi=None):
+    """Validates the files in a directory for GFED format and parses them.
+
+    Options after ratio are keyword only, and are passed on to parse_files.
+
+    land_index may be True to walk only land cells, or a path to an .npz
+    file where the land cell index is saved to and reused from. With more
+    than one worker, files are validated and parsed in a process pool.
+    Splits are written in file_format, one of dataset.FORMATS. Validation
+    results are cached in the manifest JSON file, if a path is given. Stage
+    timings and counters are written to metrics_path as JSON, if given.
+    Entries hold the emissions data of the window x window cells around each
+    cell, see GFEDDataParser. With stratified the entries are sampled a column
+    at a time with sample_block, seeded with seed, rather than by
+    get_subsample, and are parsed in a single process.
+
+    Progress is saved to checkpoint_path, if given. With resume the run
+    carries on from that checkpoint up to size entries in total, and with
+    append it carries on to write up to size more entries, such as from new
+    files added since.
+
+    Decoded month datasets are read from and saved to a SlabCache in
+    cache_directory, if given, of up to cache_size bytes.
+
+    With prefetch above 0 month datasets are read into the cache up to
+    prefetch months ahead in a background process, see GFEDDataParser. This
+    only applies when parsing in a single process.
+
+    roi may be a roi.RegionOfInterest to parse only the files, land cells, and
+    months inside it.
+    """
+    metrics = Metrics()
     print("Processing files in directory '" + directory + "'.")
     print("The following files adhere to the expected GFED format.")
-    files = valid_files(directory)
+    with metrics.stage("validation"):
+        files = valid_files(directory, manifest, workers)
 
     print("...")
+    try:
+        cache = SlabCache(cache_directory, cache_size) if cache_directory is not None else None
+        parse_files(
+            files, size, ratio, slabs=slabs, land_index=land_index, workers=workers,
+            file_format=file_format, metrics=metrics, checkpoint_path=checkpoint_path,
+            resume=resume or append, append=append, window=window, stratified=stratified,
+            seed=seed, cache=cache, prefetch=prefetch, roi=roi
+        )
+    finally:
+        for hdf in files:
+            hdf.close()
+    if metrics_path is not None:
+        metrics.write_report(metrics_path, rates=(
+            "entries", "cells_visited", "hdf_bytes_read", "cache_bytes_read"
+        ))
+        print("Metrics report written to " + metrics_path)
+
+def parse_files(files, size, ratio, *, slabs=False, land_index=None, workers=1,
+                file_format="csv", metrics=None, checkpoint_path=None, resume=False,
+                append=False, window=1, stratified=False, seed=0, cache=None, prefetch=0,
+                roi=None):
+    """Parses validated files and writes their examples to the output splits.
+
+    Options after ratio are keyword only, see validate_and_parse.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    if roi is not None:
+        files = roi.select_files(files, [file_year(hdf.filename) for hdf in files])
     if len(files) > 1:
         print("Directory contains valid GFED HDF files for training data.")
-        parser = GFEDDataParser(files)
-        count = 0
-        # Create csvs for features and targets for training and testing.
-        if not os.path.isdir("output"):
-            os.makedirs("output")
-        with open("output/train-features.csv", "w") as csv_trainf, \
-             open("output/train-targets.csv", "w") as csv_traint, \
-             open("output/validation-features.csv", "w") as csv_valf, \
-             open("output/validation-targets.csv", "w") as csv_valt, \
-             open("output/test-features.csv", "w") as csv_testf, \
-             open("output/test-targets.csv", "w") as csv_testt:
-            trainf_writer, traint_writer = csv.writer(csv_trainf), csv.writer(csv_traint)
-            valf_writer, valt_writer = csv.writer(csv_valf), csv.writer(csv_valt)
-            testf_writer, testt_writer = csv.writer(csv_testf), csv.writer(csv_testt)
-
-            entries = get_subsample(parser, ratio)
-            while len(entries) != 0 and count < size:
-                for entry in entries:
-                    count += 1
-                    features, targets = entry[0], entry[1]
-                    if (count % 10) == 0:
-                        valf_writer.writerow(features)
-                        valt_writer.writerow(targets)
-                    elif (count % 25) == 0:
-                        testf_writer.writerow(features)
-                        testt_writer.writerow(targets)
-                    else:
-                        trainf_writer.writerow(features)
-                        traint_writer.writerow(targets)
-                    print("Entries found: " + str(count), end="\r")
-                    if count >= size:
-                        break
-
-                entries = get_subsample(parser, ratio)
+        land_cells = None
+        if roi is not None:
+            with metrics.stage("land_index"):
+                land_cells = [roi.cells(hdf) for hdf in files]
+        elif land_index:
+            with metrics.stage("land_index"):
+                land_cells = load_land_cells(files, None if land_index is True else land_index)
+        checkpoint = None
+        if resume and checkpoint_path is None:
+            raise ValueError("A checkpoint path is required to resume from")
+        if resume and not os.path.isfile(checkpoint_path):
+            raise ValueError("No checkpoint saved at '{}' to resume from".format(checkpoint_path))
+        if checkpoint_path is not None:
+            options = {
+                "ratio": ratio, "land_only": bool(land_index), "format": file_format,
+                "window": window, "sampling": "stratified" if stratified else "subsample",
+                "seed": seed if stratified else None
+            }
+            if roi is not None:
+                options["roi"] = roi.options()
+            if resume:
+                checkpoint = load_checkpoint(checkpoint_path, files, options)
+                print("Resuming from {} entries in checkpoint '{}'.".format(
+                    checkpoint.count, checkpoint_path
+                ))
+            else:
+                checkpoint = Checkpoint(checkpoint_path, files, options)
+        if append:
+            size += checkpoint.count
+        states = checkpoint.writers if checkpoint is not None else None
+        start = checkpoint.state if checkpoint is not None else None
+        remaining = size - (checkpoint.count if checkpoint is not None else 0)
+        # Create files for features and targets for training and testing.
+        with ExitStack() as stack:
+            writers = dataset.open_writers("output", file_format, stack, states)
+            pending = checkpoint.pending if checkpoint is not None else []
+            if stratified or workers == 1:
+                parser = GFEDDataParser(
+                    files, slabs=slabs or stratified, land_cells=land_cells, metrics=metrics,
+                    window=window, cache=cache, prefetch=prefetch, roi=roi
+                )
+                stack.callback(parser.close)
+                if start is not None:
+                    parser.restore(start)
+            if stratified:
+                blocks = sampled_blocks(parser, ratio, seed)
+                if len(pending) > 0:
+                    rows = [np.array(rows, dtype=np.float32) for rows in zip(*pending)]
+                    blocks = chain([(rows[0], rows[1], start)], blocks)
+                count = write_blocks(writers, blocks, size, metrics, checkpoint)
+            else:
+                if workers > 1:
+                    entry_subsamples = parse_in_parallel(
+                        files, ratio, remaining, workers, slabs=slabs, land_cells=land_cells,
+                        metrics=metrics, start=start, window=window, cache=cache, roi=roi
+                    )
+                else:
+                    entry_subsamples = subsample_states(parser, ratio)
+                stack.callback(entry_subsamples.close)
+                if len(pending) > 0:
+                    entry_subsamples = chain([(pending, start)], entry_subsamples)
+                count = write_entries(writers, entry_subsamples, size, metrics, checkpoint)
+            with metrics.stage("write"):
+                stack.close()
 
         print("Example entries parsed: " + str(count))
-        print("Example features and target values written to csvs in ouput directory.")
+        print("Example features and target values written to {}s in ouput directory.".format(
+            file_format
+        ))
     elif len(files) == 1:
         print("At least 2 valid HDF GFED files required but found 1.")
     else:
@@ -272,5 +1331,54 @@ if __name__ == "__main__":
     PARSER.add_argument("directory", help="Directory with GFED4.1s_yyyy HDF files")
     PARSER.add_argument("--size", type=int, help="No. of entries to extract", default=1000)
     PARSER.add_argument("--ratio", type=int, help="Min ratio of negative to positive examples", default=-1)
+    PARSER.add_argument("--slabs", action="store_true", help="Read whole month arrays into memory")
+    PARSER.add_argument("--land-only", action="store_true", help="Walk only land grid cells")
+    PARSER.add_argument("--land-index", help="Path to save or reuse the land cell index from")
+    PARSER.add_argument("--window", type=int, default=1,
+                        help="Odd width of the neighbourhood of cells in each entry, such as 5")
+    PARSER.add_argument("--stratified", action="store_true",
+                        help="Sample whole column blocks at --ratio rather than cell by cell")
+    PARSER.add_argument("--seed", type=int, help="Seed for stratified sampling", default=0)
+    PARSER.add_argument("--cache", help="Directory to cache decoded month datasets in")
+    PARSER.add_argument("--cache-size", type=float, help="Cache size limit in GB",
+                        default=DEFAULT_MAX_BYTES / 1024 ** 3)
+    PARSER.add_argument("--prefetch", type=int, default=0,
+                        help="Months to read ahead in a background process, such as 12")
+    PARSER.add_argument("--bbox", type=float, nargs=4, metavar=("SOUTH", "NORTH", "WEST", "EAST"),
+                        help="Bounding box of the region of interest in degrees")
+    PARSER.add_argument("--regions", type=int, nargs="+", help="Basis region IDs to parse")
+    PARSER.add_argument("--years", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help="Range of years to parse")
+    PARSER.add_argument("--months", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help="Range of months to parse in each year")
+    PARSER.add_argument("--workers", type=int, help="No. of processes to parse with", default=1)
+    PARSER.add_argument("--format", choices=dataset.FORMATS, help="Split format", default="csv")
+    PARSER.add_argument("--manifest", help="Path of the cached validation results",
+                        default="output/validation-manifest.json")
+    PARSER.add_argument("--metrics", help="Path to write a JSON report of timings and counters")
+    PARSER.add_argument("--checkpoint", help="Path to save progress to and resume from",
+                        default="output/checkpoint.json")
+    PARSER.add_argument("--resume", action="store_true", help="Resume from the checkpoint")
+    PARSER.add_argument("--append", action="store_true",
+                        help="Resume from the checkpoint, appending up to --size more entries")
     ARGS = PARSER.parse_args()
-    validate_and_parse(ARGS.directory, ARGS.size, ARGS.ratio)
+    if ARGS.window < 1 or ARGS.window % 2 == 0:
+        PARSER.error("--window must be odd and positive")
+    if (ARGS.resume or ARGS.append) and not os.path.isfile(ARGS.checkpoint):
+        PARSER.error("No checkpoint saved at '{}' to resume or append from, run without "
+                     "--resume or --append first".format(ARGS.checkpoint))
+    ROI = None
+    if any(value is not None for value in (ARGS.bbox, ARGS.regions, ARGS.years, ARGS.months)):
+        try:
+            ROI = RegionOfInterest(ARGS.bbox, ARGS.regions, ARGS.years, ARGS.months)
+        except ValueError as error:
+            PARSER.error(str(error))
+    validate_and_parse(
+        ARGS.directory, ARGS.size, ARGS.ratio, slabs=ARGS.slabs,
+        land_index=ARGS.land_index or ARGS.land_only, workers=ARGS.workers,
+        file_format=ARGS.format, manifest=ARGS.manifest, metrics_path=ARGS.metrics,
+        checkpoint_path=ARGS.checkpoint, resume=ARGS.resume, append=ARGS.append,
+        window=ARGS.window, stratified=ARGS.stratified, seed=ARGS.seed,
+        cache_directory=ARGS.cache, cache_size=int(ARGS.cache_size * 1024 ** 3),
+        prefetch=ARGS.prefetch, roi=ROI
+    )
@@ -0,0 +1,125 @@
+"""The roi module narrows preprocessing to a region of interest of GFED files, so its
+cost scales with the size of the region rather than that of the globe.
+
+A region of interest may be a latitude and longitude bounding box, a set of
+basis region IDs, a range of years, and a range of months within each year, in
+any combination. Boxes are mapped to row and column index ranges using the lat
+and lon datasets, and the cells walked are the land cells inside the box, and
+inside the given basis regions. The parser then reads only the rows and
+columns around those cells, widened to the HDF5 chunk layout, since whole
+chunks are decompressed whatever part of them is read.
+"""
+
+import numpy as np
+
+class RegionOfInterest:
+    """A bounding box, basis region IDs, and year and month ranges to parse.
+
+    Any of them may be None to leave that dimension unrestricted.
+    """
+
+    def __init__(self, bbox=None, regions=None, years=None, months=None):
+        """bbox is (south, north, west, east) in degrees, where a west above east
+        crosses the antimeridian. regions is a list of basis region IDs, and years
+        and months are inclusive (first, last) ranges, with months 1 to 12.
+        """
+        if bbox is not None and bbox[0] > bbox[1]:
+            raise ValueError("Bounding box south {} is north of north {}".format(bbox[0], bbox[1]))
+        if months is not None and not 1 <= months[0] <= months[1] <= 12:
+            raise ValueError("Months must be an increasing range within 1 to 12, not {}".format(
+                months
+            ))
+        if years is not None and years[0] > years[1]:
+            raise ValueError("Years must be an increasing range, not {}".format(years))
+        self.bbox = tuple(bbox) if bbox is not None else None
+        self.regions = sorted(regions) if regions is not None else None
+        self.years = tuple(years) if years is not None else None
+        self.months = tuple(months) if months is not None else (1, 12)
+
+    def options(self):
+        """Gets the region as a JSON serialisable dict, such as for checkpoints."""
+        return {
+            "bbox": list(self.bbox) if self.bbox is not None else None,
+            "regions": self.regions,
+            "years": list(self.years) if self.years is not None else None,
+            "months": list(self.months)
+        }
+
+    def select_files(self, files, years):
+        """Gets the files whose yyyy year string in years is within the year range.
+
+        The first file after the range is kept too, as it supplies the targets
+        of the last year's December. The parser skips its entries.
+        """
+        if self.years is None:
+            return list(files)
+        selected = [
+            hdf for hdf, year in zip(files, years) if self.years[0] <= int(year) <= self.years[1]
+        ]
+        following = [hdf for hdf, year in zip(files, years) if int(year) > self.years[1]]
+        return selected + following[:1] if len(selected) > 0 else []
+
+    def index_ranges(self, hdf):
+        """Gets the (first, last + 1) row range and a column mask inside the bounding box.
+
+        Rows and columns are found from the first column of lat and first
+        row of lon, so only those are read.
+        """
+        rows, columns = hdf["ancill/basis_regions"].shape
+        if self.bbox is None:
+            return (0, rows), np.ones(columns, dtype=bool)
+        south, north, west, east = self.bbox
+        lat, lon = hdf["lat"][:, 0], hdf["lon"][0, :]
+        inside = np.flatnonzero((lat >= south) & (lat <= north))
+        if west <= east:
+            column_mask = (lon >= west) & (lon <= east)
+        else:
+            column_mask = (lon >= west) | (lon <= east)
+        if len(inside) == 0:
+            return (0, 0), column_mask
+        return (int(inside[0]), int(inside[-1]) + 1), column_mask
+
+    def cells(self, hdf):
+        """Builds an (n, 2) array of the i, j positions of the region's land cells in a file.
+
+        Positions are ordered as the parser visits them, by column j and then
+        by row i, like preprocess.build_land_cells.
+        """
+        (first, last), column_mask = self.index_ranges(hdf)
+        columns = np.flatnonzero(column_mask)
+        if first == last or len(columns) == 0:
+            return np.empty((0, 2), dtype=np.int64)
+        start, stop = int(columns[0]), int(columns[-1]) + 1
+        regions = hdf["ancill/basis_regions"][first:last, start:stop]
+        inside = regions != 0
+        if self.regions is not None:
+            inside &= np.isin(regions, self.regions)
+        inside &= column_mask[np.newaxis, start:stop]
+        j, i = np.nonzero(inside.T)
+        return np.stack([i + first, j + start], axis=1)
+
+def read_box(cells, shape, chunks=None, pad=0):
+    """Gets the (row slice, column slice) of a grid to read to parse some cells.
+
+    cells is a list of (n, 2) cell position arrays, such as one per file.
+    The box covers the cells and pad cells around them, for neighbourhood
+    windows. Rows are clipped to the grid, while columns that would wrap
+    around the grid's edge read every column. The box is then widened to
+    the chunk boundaries of chunks, if given.
+    """
+    cells = np.concatenate(cells) if len(cells) > 0 else np.empty((0, 2), dtype=np.int64)
+    if len(cells) == 0:
+        return slice(0, 0), slice(0, 0)
+    rows, columns = shape
+    first_row = max(int(cells[:, 0].min()) - pad, 0)
+    last_row = min(int(cells[:, 0].max()) + pad + 1, rows)
+    first_column = int(cells[:, 1].min()) - pad
+    last_column = int(cells[:, 1].max()) + pad + 1
+    if first_column < 0 or last_column > columns:
+        first_column, last_column = 0, columns
+    if chunks is not None:
+        first_row -= first_row % chunks[0]
+        last_row = min(-(-last_row // chunks[0]) * chunks[0], rows)
+        first_column -= first_column % chunks[1]
+        last_column = min(-(-last_column // chunks[1]) * chunks[1], columns)
+    return slice(first_row, last_row), slice(first_column, last_column)
@@ -0,0 +1,277 @@
+"""The serve module runs a resident prediction server, so the model is loaded once
+rather than on every predict.py call.
+
+Rows of features are POSTed to /predict as .csv text (or as JSON with an "inputs"
+list of rows) and the predicted values for the following month are returned in
+the same format. Requests arriving together are merged into micro-batches of up
+to --max-batch-size rows, waiting at most --max-wait seconds for a batch to fill,
+before being passed to the model, with one call per number of columns so a
+request with the wrong number of columns only fails itself. GET /stats returns
+latency and throughput statistics as JSON.
+
+The server listens on a local HTTP port, or on a Unix socket if --socket is given.
+With --engine numpy the model is run with NumPy alone, without loading TensorFlow.
+"""
+
+import io
+import os
+import json
+import time
+import queue
+import threading
+from collections import deque
+from socketserver import ThreadingMixIn, UnixStreamServer
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import numpy as np
+
+from fireemissionsai import engine
+from fireemissionsai.predict import load_predict_fn
+
+# Number of recent request latencies kept for percentile statistics.
+LATENCY_WINDOW = 1000
+
+class BatchRequest:
+    """Rows of features waiting on a micro-batch, and their predictions when done."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.submitted = time.perf_counter()
+        self.done = threading.Event()
+        self.predictions, self.error = None, None
+
+    def result(self):
+        """Waits for the request's batch and returns its predictions or raises its error."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.predictions
+
+class MicroBatcher:
+    """Merges concurrently submitted rows into batches for a single predict function.
+
+    A background thread takes the first waiting request, then keeps taking
+    requests until max_batch_size rows are gathered or max_wait seconds have
+    passed, and predicts them with one call to predict_fn for each number of
+    columns among them.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=1024, max_wait=0.005):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.counts = {"requests": 0, "rows": 0, "batches": 0, "errors": 0}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, rows):
+        """Queues a 2D array of rows for prediction and returns its BatchRequest.
+
+        Raises ValueError if rows is not 2D with at least one row and column.
+        """
+        rows = np.asarray(rows)
+        if rows.ndim != 2 or rows.shape[0] == 0 or rows.shape[1] == 0:
+            raise ValueError("Expected a 2D array of rows, not shape {}".format(rows.shape))
+        request = BatchRequest(rows)
+        self.requests.put(request)
+        return request
+
+    def predict(self, rows):
+        """Predicts rows as part of a micro-batch, blocking until they are done."""
+        return self.submit(rows).result()
+
+    def next_batch(self):
+        """Blocks for the next group of requests to predict together, or None to stop."""
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch, rows = [first], len(first.rows)
+        deadline = time.perf_counter() + self.max_wait
+        while rows < self.max_batch_size:
+            try:
+                request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)
+                break
+            batch.append(request)
+            rows += len(request.rows)
+        return batch
+
+    def run(self):
+        """Predicts batches until stop is called."""
+        batch = self.next_batch()
+        while batch is not None:
+            self.predict_batch(batch)
+            batch = self.next_batch()
+
+    def predict_batch(self, batch):
+        """Predicts a group of requests and hands each its predictions.
+
+        Requests are predicted with one call per number of columns, so an
+        error only reaches the requests whose rows were predicted with it.
+        """
+        groups = {}
+        for request in batch:
+            groups.setdefault(request.rows.shape[1], []).append(request)
+        for group in groups.values():
+            try:
+                predictions = self.predict_fn(np.concatenate([request.rows for request in group]))
+                start = 0
+                for request in group:
+                    request.predictions = predictions[start:start + len(request.rows)]
+                    start += len(request.rows)
+            except Exception as error: # pylint: disable=broad-except
+                for request in group:
+                    request.error = error
+        finished = time.perf_counter()
+        with self.lock:
+            self.counts["batches"] += 1
+            self.counts["requests"] += len(batch)
+            self.counts["rows"] += sum(len(request.rows) for request in batch)
+            self.counts["errors"] += sum(request.error is not None for request in batch)
+            self.latencies.extend(finished - request.submitted for request in batch)
+        for request in batch:
+            request.done.set()
+
+    def stats(self):
+        """Gets request counts, throughput, and recent latency percentiles as a dict."""
+        with self.lock:
+            stats = dict(self.counts)
+            latencies = np.array(self.latencies)
+        uptime = time.perf_counter() - self.started
+        stats["uptime_seconds"] = uptime
+        stats["rows_per_second"] = stats["rows"] / uptime if uptime > 0 else 0.0
+        stats["mean_batch_rows"] = stats["rows"] / stats["batches"] if stats["batches"] else 0.0
+        for percentile in (50, 95, 99):
+            latency = np.percentile(latencies, percentile) * 1000 if len(latencies) else 0.0
+            stats["latency_p{}_ms".format(percentile)] = float(latency)
+        return stats
+
+    def stop(self):
+        """Stops the background thread once queued requests are predicted."""
+        self.requests.put(None)
+        self.thread.join()
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """Handles /predict and /stats requests using the server's MicroBatcher."""
+    # Keep connections alive between requests, every response has a Content-Length.
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """Returns the batcher's statistics from /stats."""
+        if self.path != "/stats":
+            self.send_error(404)
+            return
+        self.respond(200, "application/json", json.dumps(self.server.batcher.stats()))
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """Predicts the .csv or JSON rows POSTed to /predict."""
+        if self.path != "/predict":
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        as_json = self.headers.get("Content-Type", "").startswith("application/json")
+        try:
+            if as_json:
+                rows = np.array(json.loads(body)["inputs"], dtype=np.float32, ndmin=2)
+            else:
+                rows = np.loadtxt(io.StringIO(body), delimiter=",", ndmin=2, dtype=np.float32)
+        except (ValueError, KeyError, TypeError) as error:
+            self.respond(400, "text/plain", "Invalid input rows: {}\n".format(error))
+            return
+        try:
+            request = self.server.batcher.submit(rows)
+        except ValueError as error:
+            self.respond(400, "text/plain", "Invalid input rows: {}\n".format(error))
+            return
+        try:
+            predictions = request.result()
+        except Exception as error: # pylint: disable=broad-except
+            self.respond(500, "text/plain", "Prediction failed: {}\n".format(error))
+            return
+        if as_json:
+            self.respond(200, "application/json", json.dumps({"predictions": predictions.tolist()}))
+        else:
+            output = io.StringIO()
+            np.savetxt(output, predictions, delimiter=",")
+            self.respond(200, "text/csv", output.getvalue())
+
+    def respond(self, status, content_type, body):
+        """Sends a complete response with the given status, content type, and text body."""
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        """Silences per-request logging, use /stats instead."""
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server handling each request to a MicroBatcher in its own thread."""
+    daemon_threads = True
+
+    def __init__(self, address, handler, batcher):
+        super().__init__(address, handler)
+        self.batcher = batcher
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """A Unix socket HTTP server handling each request to a MicroBatcher in its own thread."""
+    daemon_threads = True
+
+    def __init__(self, address, handler, batcher):
+        super().__init__(address, handler)
+        self.batcher = batcher
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address.
+        return request, ("unix", 0)
+
+def create_server(batcher, port=8080, host="127.0.0.1", socket_path=None):
+    """Creates an HTTP server for a MicroBatcher on a port, or on a Unix socket path."""
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, PredictionHandler, batcher)
+    return ThreadingHTTPServer((host, port), PredictionHandler, batcher)
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    PARSER.add_argument("--model", help="Path to the persisted model", default="model_weights.h5")
+    PARSER.add_argument("--host", help="Host to listen on", default="127.0.0.1")
+    PARSER.add_argument("--port", type=int, help="Port to listen on", default=8080)
+    PARSER.add_argument("--socket", help="Unix socket path to listen on instead of a port")
+    PARSER.add_argument("--max-batch-size", type=int, help="Max rows per batch", default=1024)
+    PARSER.add_argument("--max-wait", type=float, help="Max seconds to fill a batch", default=0.005)
+    PARSER.add_argument("--engine", choices=("keras", "numpy"), help="Engine to predict with",
+                        default="keras")
+    PARSER.add_argument("--engine-dtype", choices=engine.DTYPES, default="float32",
+                        help="Type of the weights exported for the numpy engine")
+    PARSER.add_argument("--debug", dest='debug', action='store_true')
+    ARGS = PARSER.parse_args()
+
+    if not ARGS.debug:
+        os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+    BATCHER = MicroBatcher(
+        load_predict_fn(ARGS.model, ARGS.engine, ARGS.engine_dtype), ARGS.max_batch_size,
+        ARGS.max_wait
+    )
+    SERVER = create_server(BATCHER, ARGS.port, ARGS.host, ARGS.socket)
+    print("Serving predictions on " + (ARGS.socket or "{}:{}".format(ARGS.host, ARGS.port)))
+    try:
+        SERVER.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        SERVER.server_close()
+        BATCHER.stop()
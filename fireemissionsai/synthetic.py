@@ -0,0 +1,114 @@
+"""The synthetic module generates GFED4.1s_yyyy.hdf5 format files filled with
+random but plausible values, for testing and benchmarking at any grid size.
+
+Each file has the lat, lon, and ancill/basis_regions datasets and the monthly
+biosphere, emissions, and burned_area datasets that the preprocess module
+validates, stored as gzip compressed chunked float32 datasets like GFED files.
+Land is laid out in smooth blobs covering the requested fraction of the grid,
+and only a fraction of land cells burn in any month.
+"""
+
+import os
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+import h5py
+import numpy as np
+
+from fireemissionsai import preprocess
+
+# Grid shape of GFED4.1s files, at 0.25 degree resolution.
+GFED_SHAPE = (720, 1440)
+# Number of GFED basis regions, excluding 0 for ocean.
+BASIS_REGIONS = 14
+
+def smooth_field(shape, rng, passes=4):
+    """Gets a random field smoothed by repeated neighbour averaging, wrapping in longitude."""
+    field = rng.rand(*shape)
+    for _ in range(passes):
+        field = (field + np.roll(field, 1, axis=1) + np.roll(field, -1, axis=1)
+                 + np.roll(field, 1, axis=0) + np.roll(field, -1, axis=0)) / 5
+    return field
+
+def land_regions(shape, land_fraction, rng):
+    """Gets a basis regions array with land_fraction of cells in non-zero regions."""
+    field = smooth_field(shape, rng)
+    land = field >= np.quantile(field, 1 - land_fraction) if land_fraction > 0 else field < 0
+    # Regions are bands of longitude, much like GFED's continental regions.
+    bands = np.arange(shape[1]) * BASIS_REGIONS // shape[1] + 1
+    return np.where(land, bands[np.newaxis, :], 0).astype(np.float32)
+
+def write_synthetic_file(path, shape=GFED_SHAPE, land_fraction=0.3, fire_fraction=0.05, seed=0,
+                         chunks=(180, 360), compression="gzip", regions=None):
+    """Writes a synthetic GFED format file to path and returns the path.
+
+    land_fraction of cells are land, unless a basis regions array is given,
+    and each month about fire_fraction of land cells have a non-zero burned
+    fraction. Chunks are clipped to shape.
+    """
+    rows, columns = shape
+    chunks = (min(chunks[0], rows), min(chunks[1], columns)) if chunks else None
+    if regions is None:
+        regions = land_regions(shape, land_fraction, np.random.RandomState([seed, 0]))
+    rng = np.random.RandomState([seed, 1])
+    land = regions != 0
+    step = 180.0 / rows, 360.0 / columns
+    lat = 90 - step[0] / 2 - step[0] * np.arange(rows)
+    lon = -180 + step[1] / 2 + step[1] * np.arange(columns)
+
+    def create(hdf, name, values):
+        hdf.create_dataset(name, data=values.astype(np.float32), chunks=chunks,
+                           compression=compression)
+
+    with h5py.File(path, "w") as hdf:
+        create(hdf, "lat", np.repeat(lat[:, np.newaxis], columns, axis=1))
+        create(hdf, "lon", np.repeat(lon[np.newaxis, :], rows, axis=0))
+        create(hdf, "ancill/basis_regions", regions)
+        for month in range(1, 13):
+            burning = land & (rng.rand(rows, columns) < fire_fraction)
+            burned = np.where(burning, rng.beta(0.5, 20, shape), 0)
+            values = {
+                "BB": burned * rng.gamma(2, 50, shape),
+                "NPP": np.where(land, rng.gamma(2, 40, shape), 0),
+                "Rh": np.where(land, rng.gamma(2, 35, shape), 0),
+                "C": burned * rng.gamma(2, 25, shape),
+                "DM": burned * rng.gamma(2, 55, shape),
+                "burned_fraction": burned
+            }
+            for name in preprocess.MONTHLY_DATASETS:
+                create(hdf, name.format(month), values[name.split("/")[-1]])
+    return path
+
+def generate(directory, years, shape=GFED_SHAPE, land_fraction=0.3, fire_fraction=0.05, seed=0,
+             first_year=2000, **options):
+    """Writes a synthetic GFED4.1s_yyyy.hdf5 file for each of a number of years.
+
+    Every year shares the same land layout, as real GFED files do. Returns
+    the paths of the files written.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    regions = land_regions(shape, land_fraction, np.random.RandomState([seed, 0]))
+    paths = []
+    for year in range(first_year, first_year + years):
+        path = os.path.join(directory, "GFED4.1s_{}.hdf5".format(year))
+        paths.append(write_synthetic_file(
+            path, shape, land_fraction, fire_fraction, seed + year - first_year,
+            regions=regions, **options
+        ))
+    return paths
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    PARSER.add_argument("directory", help="Directory to write GFED4.1s_yyyy.hdf5 files to")
+    PARSER.add_argument("--years", type=int, help="No. of yearly files to write", default=2)
+    PARSER.add_argument("--first-year", type=int, help="Year of the first file", default=2000)
+    PARSER.add_argument("--shape", type=int, nargs=2, help="Grid rows and columns",
+                        default=GFED_SHAPE)
+    PARSER.add_argument("--land", type=float, help="Fraction of cells that are land", default=0.3)
+    PARSER.add_argument("--fire", type=float, help="Fraction of land cells burning each month",
+                        default=0.05)
+    PARSER.add_argument("--seed", type=int, help="Random seed", default=0)
+    ARGS = PARSER.parse_args()
+    for PATH in generate(ARGS.directory, ARGS.years, tuple(ARGS.shape), ARGS.land, ARGS.fire,
+                         ARGS.seed, ARGS.first_year):
+        print("Wrote " + PATH)
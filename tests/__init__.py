@@ -2,4 +2,13 @@
 
 The package includes the following modules;
 test_preprocess - tests for converting GFED hdf files to training examples.
+test_dataset - tests for reading and writing training example splits.
+test_serve - tests for the micro-batching prediction server.
+test_synthetic - tests for the synthetic GFED generator and benchmark suite.
+test_metrics - tests for stage timings, counters, and progress output.
+test_engine - tests for exporting models and predicting with NumPy alone.
+test_cache - tests for the decoded month dataset cache.
+test_roi - tests for parsing a region of interest.
+test_evaluation - tests for streamed per region evaluation.
+fixtures - temporary directory and GFED file fixtures shared by the tests.
 """
@@ -0,0 +1,68 @@
+"""Shared fixtures for tests that write GFED files and splits to a temporary directory."""
+
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+from unittest import TestCase
+from fireemissionsai import synthetic
+
+class TemporaryDirectoryTestCase(TestCase):
+    """A TestCase with a temporary directory for each test, removed after it.
+
+    Files opened with open_files are closed, and the working directory
+    changed with change_directory is restored, before the directory is removed.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def open_files(self, paths):
+        """Opens hdf files for reading, closing them after the test."""
+        files = [h5py.File(path, "r") for path in paths]
+        for hdf in files:
+            self.addCleanup(hdf.close)
+        return files
+
+    def change_directory(self):
+        """Changes the working directory to the temporary directory until after the test."""
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.directory)
+
+def split_files(file_format):
+    """Reads the bytes of each split file of a format in the output directory."""
+    contents = {}
+    for name in sorted(os.listdir("output")):
+        if name.endswith("." + file_format):
+            with open(os.path.join("output", name), "rb") as split_file:
+                contents[name] = split_file.read()
+    return contents
+
+def write_gfed_file(path, shape=(4, 3), seed=0, chunks=None, compression=None, regions=None):
+    """Writes a small random GFED format hdf file for exercising the parser.
+
+    Files are unchunked and uncompressed unless chunks and compression are
+    given, and have their own land layout unless a regions array is given.
+    """
+    return synthetic.write_synthetic_file(
+        path, shape, land_fraction=0.6, fire_fraction=0.5, seed=seed, chunks=chunks,
+        compression=compression, regions=regions
+    )
+
+def write_gfed_files(directory, years=(2016, 2017), shape=(4, 3), chunks=None,
+                     compression=None, shared_land=False):
+    """Writes a small random GFED format hdf file for each year, seeded on the year.
+
+    With shared_land every file has the same land layout, as real GFED years do.
+    """
+    regions = synthetic.land_regions(shape, 0.6, np.random.RandomState(0)) if shared_land else None
+    return [
+        write_gfed_file(
+            os.path.join(directory, "GFED_{}.hdf5".format(year)), shape, year, chunks,
+            compression, regions
+        )
+        for year in years
+    ]
@@ -0,0 +1,43 @@
+import os
+import time
+
+import numpy as np
+from fireemissionsai.cache import SlabCache
+from tests.fixtures import TemporaryDirectoryTestCase
+
+class TestSlabCache(TemporaryDirectoryTestCase):
+    """Test the cache.SlabCache reads, writes, and eviction."""
+
+    def test_get_and_put(self):
+        """Test arrays are cached as float32 and read back memory-mapped."""
+        cache = SlabCache(self.directory)
+        source = {"size": 10, "mtime_ns": 1}
+        key = (2016, 1, "biosphere/BB")
+        self.assertIsNone(cache.get(key, source))
+        array = np.arange(12, dtype=np.float64).reshape(3, 4)
+        self.assertEqual(cache.put(key, source, array).dtype, np.float32)
+        cached = cache.get(key, source)
+        self.assertIsInstance(cached, np.memmap)
+        np.testing.assert_array_equal(cached, array.astype(np.float32))
+        self.assertIsNone(cache.get((2016, 2, "biosphere/BB"), source))
+        self.assertIsNone(cache.get(key, {"size": 10, "mtime_ns": 2}))
+        self.assertEqual(cache.size(), os.path.getsize(cache.path(key, source)))
+
+    def test_least_recently_used_eviction(self):
+        """Test the least recently used arrays are evicted to stay under the cap."""
+        array = np.zeros((16, 16), dtype=np.float32)
+        cache = SlabCache(self.directory)
+        source = {"size": 10, "mtime_ns": 1}
+        cache.put((2016, 1, "C"), source, array)
+        cache = SlabCache(self.directory, max_bytes=cache.size() * 2)
+        cache.put((2016, 2, "C"), source, array)
+        time.sleep(0.01)
+        self.assertIsNotNone(cache.get((2016, 1, "C"), source))
+        time.sleep(0.01)
+        cache.put((2016, 3, "C"), source, array)
+        self.assertIsNotNone(cache.get((2016, 1, "C"), source))
+        self.assertIsNone(cache.get((2016, 2, "C"), source))
+        self.assertIsNotNone(cache.get((2016, 3, "C"), source))
+        self.assertTrue(cache.size() <= cache.max_bytes)
+        cache.put((2016, 4, "C"), source, np.zeros((64, 64)))
+        self.assertIsNone(cache.get((2016, 4, "C"), source))
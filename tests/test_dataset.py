@@ -0,0 +1,133 @@
+import os.path
+from contextlib import ExitStack
+
+import numpy as np
+from fireemissionsai import dataset
+from tests.fixtures import TemporaryDirectoryTestCase
+
+class TestNpyWriter(TemporaryDirectoryTestCase):
+    """Test the dataset.NpyWriter."""
+
+    def test_write_and_load(self):
+        """Test rows and arrays written are loaded memory-mapped with the right shape."""
+        path = os.path.join(self.directory, "train-features.npy")
+        rows = np.random.RandomState(0).rand(dataset.NPY_BUFFER_ROWS + 10, 3)
+        with dataset.NpyWriter(path) as writer:
+            writer.writerow(["2018", 1, 0.5])
+            for row in rows[:-5]:
+                writer.writerow(row)
+            writer.writerows(rows[-5:])
+        loaded = np.load(path, mmap_mode="r")
+        self.assertIsInstance(loaded, np.memmap)
+        self.assertEqual(loaded.dtype, np.float32)
+        self.assertEqual(loaded.shape, (len(rows) + 1, 3))
+        np.testing.assert_array_equal(loaded[0], [2018, 1, 0.5])
+        np.testing.assert_array_equal(loaded[1:], rows.astype(np.float32))
+
+    def test_column_mismatch(self):
+        """Test rows with a different number of columns are rejected."""
+        path = os.path.join(self.directory, "train-targets.npy")
+        with dataset.NpyWriter(path) as writer:
+            writer.writerows([[1, 2]])
+            with self.assertRaises(ValueError):
+                writer.writerows([[1, 2, 3]])
+
+
+class TestSplits(TemporaryDirectoryTestCase):
+    """Test opening, loading, and exporting the dataset splits."""
+
+    def test_formats_load_the_same(self):
+        """Test splits written as .npy and .csv load and export to the same values."""
+        rows = np.random.RandomState(1).rand(30, 4).astype(np.float32)
+        directories = {}
+        for file_format in dataset.FORMATS:
+            directories[file_format] = os.path.join(self.directory, file_format)
+            with ExitStack() as stack:
+                writers = dataset.open_writers(directories[file_format], file_format, stack)
+                for split in dataset.SPLITS:
+                    for writer in writers[split]:
+                        for row in rows:
+                            writer.writerow(list(row))
+        dataset.export_csv(directories["npy"])
+        for split in dataset.SPLITS:
+            npy = dataset.load_split(split, "features", directories["npy"])
+            csv = dataset.load_split(split, "targets", directories["csv"])
+            np.testing.assert_array_equal(npy, rows)
+            np.testing.assert_allclose(csv, rows, rtol=1e-6)
+            exported = np.genfromtxt(
+                dataset.split_path(directories["npy"], split, "targets", "csv"), delimiter=","
+            )
+            np.testing.assert_array_equal(exported.astype(np.float32), rows)
+
+    def test_stale_format_removed(self):
+        """Test writing splits in one format removes the other format's stale splits."""
+        for file_format, count in (("npy", 30), ("csv", 5)):
+            with ExitStack() as stack:
+                writers = dataset.open_writers(self.directory, file_format, stack)
+                writers["train"][0].writerows(np.ones((count, 3)))
+                writers["train"][1].writerows(np.ones((count, 2)))
+        self.assertFalse(
+            os.path.isfile(dataset.split_path(self.directory, "train", "features", "npy"))
+        )
+        self.assertEqual(dataset.load_split("train", "features", self.directory).shape, (5, 3))
+        self.assertEqual(dataset.split_shape("train", "targets", self.directory), (5, 2))
+
+
+class TestStreaming(TemporaryDirectoryTestCase):
+    """Test streaming splits in blocks and batches."""
+
+    def test_read_blocks(self):
+        """Test blocks read from .npy and .csv splits cover every row in order."""
+        rows = np.random.RandomState(2).rand(25, 3).astype(np.float32)
+        for file_format in dataset.FORMATS:
+            directory = os.path.join(self.directory, file_format)
+            with ExitStack() as stack:
+                writers = dataset.open_writers(directory, file_format, stack)
+                for row in rows:
+                    writers["train"][0].writerow(list(row))
+                    writers["train"][1].writerow(list(row[:2]))
+            self.assertEqual(dataset.split_shape("train", "features", directory), (25, 3))
+            self.assertEqual(dataset.split_shape("train", "targets", directory), (25, 2))
+            blocks = list(dataset.read_blocks("train", directory, block_rows=10))
+            self.assertEqual([len(block[0]) for block in blocks], [10, 10, 5])
+            np.testing.assert_allclose(np.concatenate([b[0] for b in blocks]), rows, rtol=1e-6)
+            np.testing.assert_allclose(
+                np.concatenate([b[1] for b in blocks]), rows[:, :2], rtol=1e-6
+            )
+
+    def test_batches(self):
+        """Test batches keep every row once, shuffling only within the buffer."""
+        features = np.arange(100).reshape(50, 2)
+        blocks = [(features[start:start + 7], features[start:start + 7, :1])
+                  for start in range(0, 50, 7)]
+        ordered = list(dataset.batches(blocks, 8))
+        self.assertEqual([len(batch[0]) for batch in ordered], [8] * 6 + [2])
+        np.testing.assert_array_equal(np.concatenate([b[0] for b in ordered]), features)
+
+        shuffled = list(dataset.batches(blocks, 8, buffer_rows=20, seed=3))
+        self.assertEqual([len(batch[0]) for batch in shuffled], [8] * 6 + [2])
+        rows = np.concatenate([batch[0] for batch in shuffled])
+        np.testing.assert_array_equal(np.concatenate([b[1] for b in shuffled])[:, 0], rows[:, 0])
+        self.assertFalse(np.array_equal(rows, features))
+        np.testing.assert_array_equal(np.sort(rows[:, 0]), features[:, 0])
+        # The first buffer only ever holds the first 21 rows.
+        self.assertTrue(np.all(rows[:16, 0] < 42))
+        again = list(dataset.batches(blocks, 8, buffer_rows=20, seed=3))
+        np.testing.assert_array_equal(np.concatenate([b[0] for b in again]), rows)
+
+    def test_prefetched(self):
+        """Test prefetched items arrive in order and errors reach the consumer."""
+        self.assertEqual(list(dataset.prefetched(iter(range(10)), depth=2)), list(range(10)))
+
+        def failing():
+            yield 1
+            raise IOError("Read failed")
+        items = dataset.prefetched(failing())
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(IOError):
+            next(items)
+
+        # Closing early leaves the producer thread free to stop.
+        items = dataset.prefetched(iter(range(100)))
+        self.assertEqual(next(items), 0)
+        items.close()
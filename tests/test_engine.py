@@ -0,0 +1,124 @@
+import os.path
+import json
+
+import h5py
+import numpy as np
+from fireemissionsai import engine, predict
+from tests.fixtures import TemporaryDirectoryTestCase
+
+def reference_predict(layers, inputs):
+    """Predicts with (class name, config, weights) layers as Keras would, without folding."""
+    values = np.asarray(inputs, dtype=np.float64)
+    for class_name, config, weights in layers:
+        if class_name == "Dense":
+            values = values @ weights["kernel"] + weights["bias"]
+            if config["activation"] == "relu":
+                values = np.maximum(values, 0)
+        elif class_name == "BatchNormalization":
+            values = weights["gamma"] * (values - weights["moving_mean"]) / np.sqrt(
+                weights["moving_variance"] + config["epsilon"]
+            ) + weights["beta"]
+    return values
+
+def write_keras_model(path, sizes=(11, 32, 32, 6), seed=0, final_batch_norm=False):
+    """Writes a Keras 2 format model file shaped like construct_model, with random weights."""
+    rng = np.random.RandomState(seed)
+    layers = []
+    for index, (inputs, units) in enumerate(zip(sizes[:-1], sizes[1:])):
+        layers.append(("Dense", {"name": "dense_{}".format(index + 1), "units": units,
+                                 "activation": "relu", "use_bias": True}, {
+                                     "kernel": rng.randn(inputs, units) / np.sqrt(inputs),
+                                     "bias": rng.randn(units) * 0.1
+                                 }))
+        if index == 0 or (final_batch_norm and index == len(sizes) - 2):
+            layers.append(("BatchNormalization", {
+                "name": "batch_normalization_{}".format(index + 1), "epsilon": 0.001
+            }, {
+                "gamma": rng.rand(units) + 0.5, "beta": rng.randn(units) * 0.1,
+                "moving_mean": rng.rand(units), "moving_variance": rng.rand(units) + 0.1
+            }))
+    with h5py.File(path, "w") as hdf:
+        hdf.attrs["model_config"] = json.dumps({"class_name": "Sequential", "config": [
+            {"class_name": class_name, "config": config} for class_name, config, _ in layers
+        ]}).encode("utf8")
+        group = hdf.create_group("model_weights")
+        group.attrs["layer_names"] = [config["name"].encode("utf8") for _, config, _ in layers]
+        for _, config, weights in layers:
+            layer = group.create_group(config["name"])
+            names = ["{}/{}:0".format(config["name"], name) for name in weights]
+            layer.attrs["weight_names"] = [name.encode("utf8") for name in names]
+            for name, values in zip(names, weights.values()):
+                layer.create_dataset(name, data=values.astype(np.float32))
+    return layers
+
+class TestEngine(TemporaryDirectoryTestCase):
+    """Test the engine export and NumPy forward pass."""
+
+    def test_matches_reference(self):
+        """Test exported models predict as the unfolded layers do, within tolerance per type."""
+        inputs = np.random.RandomState(1).randn(500, 11).astype(np.float32)
+        for final_batch_norm in (False, True):
+            path = os.path.join(self.directory, "model.h5")
+            layers = write_keras_model(path, final_batch_norm=final_batch_norm)
+            expected = reference_predict(layers, inputs)
+            scale = np.abs(expected).max()
+            np.testing.assert_allclose(
+                engine.from_keras(path).predict(inputs), expected, atol=1e-5 * scale
+            )
+            for dtype, tolerance in (("float32", 1e-5), ("float16", 1e-2), ("int8", 5e-2)):
+                weights_path = engine.export(
+                    path, os.path.join(self.directory, dtype + ".npz"), dtype
+                )
+                predictions = engine.load(weights_path).predict(inputs, batch_size=64)
+                self.assertEqual(predictions.dtype, np.float32)
+                np.testing.assert_allclose(predictions, expected, atol=tolerance * scale)
+        sizes = [
+            os.path.getsize(os.path.join(self.directory, dtype + ".npz")) for dtype in engine.DTYPES
+        ]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+
+    def test_persisted_model(self):
+        """Test the persisted Keras model is read and predicted as its layers would be."""
+        layers = engine.read_keras_layers("model_weights.h5")
+        self.assertEqual([layer[0] for layer in layers], ["Dense", "BatchNormalization"] + [
+            "Dense"
+        ] * 3)
+        inputs = np.random.RandomState(2).rand(100, 11) * [
+            2018, 12, 90, 180, 14, 100, 100, 100, 10, 100, 0.1
+        ]
+        expected = reference_predict(layers, inputs)
+        np.testing.assert_allclose(
+            engine.from_keras("model_weights.h5").predict(inputs), expected,
+            rtol=1e-4, atol=1e-4 * np.abs(expected).max()
+        )
+
+    def test_unsupported_layers(self):
+        """Test layers that cannot be exported are rejected."""
+        with self.assertRaises(ValueError):
+            engine.fold_layers([("Conv2D", {"name": "conv"}, {})])
+        with self.assertRaises(ValueError):
+            engine.fold_layers([("Dense", {"name": "dense", "activation": "elu"}, {
+                "kernel": np.ones((2, 2))
+            })])
+
+    def test_predict_with_numpy_engine(self):
+        """Test predict.py predicts a .csv with the numpy engine, exporting the model once."""
+        model_path = os.path.join(self.directory, "model_weights.h5")
+        layers = write_keras_model(model_path)
+        inputs = np.random.RandomState(3).randn(50, 11).astype(np.float32)
+        np.savetxt(os.path.join(self.directory, "inputs.csv"), inputs, delimiter=",")
+        predict_fn = predict.load_predict_fn(model_path, "numpy", "float16")
+        weights_path = os.path.join(self.directory, "model_weights-float16.npz")
+        self.assertTrue(os.path.isfile(weights_path))
+        modified = os.path.getmtime(weights_path)
+        predict.load_predict_fn(model_path, "numpy", "float16")
+        self.assertEqual(os.path.getmtime(weights_path), modified)
+
+        rows = predict.predict_csv(
+            predict_fn, os.path.join(self.directory, "inputs.csv"),
+            os.path.join(self.directory, "predictions.csv"), chunk_rows=16
+        )
+        self.assertEqual(rows, 50)
+        predictions = np.loadtxt(os.path.join(self.directory, "predictions.csv"), delimiter=",")
+        expected = reference_predict(layers, inputs)
+        np.testing.assert_allclose(predictions, expected, atol=1e-2 * np.abs(expected).max())
@@ -0,0 +1,108 @@
+import io
+import os.path
+import json
+from contextlib import ExitStack, redirect_stdout
+
+import numpy as np
+from fireemissionsai import dataset, evaluation, predict
+from fireemissionsai.metrics import Metrics
+from tests.fixtures import TemporaryDirectoryTestCase
+
+def expected_summary(predictions, targets):
+    """Computes each target column's MAE, RMSE, and bias over whole arrays."""
+    errors = predictions.astype(np.float64) - targets
+    return dict({"rows": len(errors)}, **{
+        name: {
+            "mae": np.abs(errors[:, column]).mean(),
+            "rmse": np.sqrt((errors[:, column] ** 2).mean()),
+            "bias": errors[:, column].mean()
+        }
+        for column, name in enumerate(evaluation.TARGET_NAMES)
+    })
+
+def assert_summaries_equal(test, summary, expected):
+    """Asserts the rows and every error of two summaries are equal to within rounding."""
+    test.assertEqual(summary["rows"], expected["rows"])
+    for name in evaluation.TARGET_NAMES:
+        for error in ("mae", "rmse", "bias"):
+            test.assertAlmostEqual(summary[name][error], expected[name][error], places=9)
+
+def write_test_split(directory, file_format, rows=1000):
+    """Writes a random test split with basis region IDs, returning its features and targets."""
+    rng = np.random.RandomState(1)
+    features = rng.rand(rows, 11)
+    features[:, evaluation.REGION_COLUMN] = rng.randint(0, 15, rows)
+    targets = rng.rand(rows, len(evaluation.TARGET_NAMES))
+    with ExitStack() as stack:
+        writers = dataset.open_writers(directory, file_format, stack)
+        writers["test"][0].writerows(features)
+        writers["test"][1].writerows(targets)
+    return dataset.load_split("test", "features", directory), dataset.load_split(
+        "test", "targets", directory
+    )
+
+class TestEvaluation(TemporaryDirectoryTestCase):
+    """Test streamed evaluation of predictions overall and per region."""
+
+    def test_running_errors(self):
+        """Test errors accumulated over blocks equal those of whole arrays."""
+        rng = np.random.RandomState(0)
+        predictions, targets = rng.rand(500, 6), rng.rand(500, 6)
+        regions = rng.randint(1, 6, 500)
+        errors = evaluation.RunningErrors()
+        for start in range(0, 500, 64):
+            errors.add(predictions[start:start + 64], targets[start:start + 64],
+                       regions[start:start + 64])
+        report = errors.report()
+        assert_summaries_equal(self, report["overall"], expected_summary(predictions, targets))
+        self.assertEqual(sorted(report["regions"]), [str(region) for region in range(1, 6)])
+        for region in range(1, 6):
+            inside = regions == region
+            assert_summaries_equal(self, report["regions"][str(region)],
+                                   expected_summary(predictions[inside], targets[inside]))
+        with self.assertRaises(ValueError):
+            errors.add(predictions[:, :5], targets[:, :5], regions)
+
+    def test_evaluate_split(self):
+        """Test a split is evaluated in blocks the same from .csv and .npy files."""
+        for file_format in dataset.FORMATS:
+            directory = os.path.join(self.directory, file_format)
+            features, targets = write_test_split(directory, file_format)
+            # Predicts this month's values for the next, as a persistence forecast.
+            errors = evaluation.evaluate_split(
+                lambda features: features[:, 5:], "test", directory, block_rows=128
+            )
+            report = errors.report()
+            assert_summaries_equal(
+                self, report["overall"], expected_summary(np.asarray(features[:, 5:]), targets)
+            )
+            for region, summary in report["regions"].items():
+                inside = features[:, evaluation.REGION_COLUMN] == int(region)
+                assert_summaries_equal(self, summary, expected_summary(
+                    np.asarray(features[inside, 5:]), np.asarray(targets[inside])
+                ))
+            self.assertEqual(sum(summary["rows"] for summary in report["regions"].values()), 1000)
+
+    def test_test_print_evaluation(self):
+        """Test test_print writes an evaluation report rather than loading the test split."""
+        features, targets = write_test_split(os.path.join(self.directory, "output"), "npy")
+
+        class Model: # pylint: disable=too-few-public-methods
+            """A model predicting this month's values for the next."""
+            def predict(self, features):
+                """Predicts the value columns of the features."""
+                return np.asarray(features[:, 5:])
+
+        metrics = Metrics()
+        self.change_directory()
+        with redirect_stdout(io.StringIO()) as output:
+            predict.test_print(Model(), None, False, metrics=metrics,
+                               evaluation_path="output/evaluation.json", chunk_rows=100)
+        with open("output/evaluation.json") as report_file:
+            report = json.load(report_file)
+        self.assertIn("Test evaluation of 1000 rows", output.getvalue())
+        self.assertEqual(metrics.stages["predict"]["calls"], 10)
+        self.assertFalse(os.path.isfile(os.path.join("output", "test-predictions.csv")))
+        assert_summaries_equal(
+            self, report["overall"], expected_summary(np.asarray(features[:, 5:]), targets)
+        )
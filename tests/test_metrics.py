@@ -0,0 +1,64 @@
+import io
+import json
+import os.path
+
+from unittest import mock
+from fireemissionsai.metrics import Metrics
+from tests.fixtures import TemporaryDirectoryTestCase
+
+class TestMetrics(TemporaryDirectoryTestCase):
+    """Test the metrics.Metrics stage timings, counters, and progress output."""
+
+    def test_stages_and_counters(self):
+        """Test stage timings and counters accumulate and are reported with rates."""
+        metrics = Metrics()
+        for _ in range(3):
+            with metrics.stage("read"):
+                pass
+        metrics.add("entries", 10)
+        metrics.add("entries")
+        report = metrics.report(rates=("entries",))
+        self.assertEqual(report["stages"]["read"]["calls"], 3)
+        self.assertTrue(report["stages"]["read"]["seconds"] >= 0)
+        self.assertEqual(report["counters"], {"entries": 11})
+        self.assertTrue(report["rates"]["entries_per_second"] > 0)
+
+    def test_stage_records_errors(self):
+        """Test a stage is timed even when its block raises."""
+        metrics = Metrics()
+        with self.assertRaises(ValueError):
+            with metrics.stage("parse"):
+                raise ValueError()
+        self.assertEqual(metrics.stages["parse"]["calls"], 1)
+
+    def test_merge(self):
+        """Test merging a worker's report adds its stages and counters."""
+        metrics, worker = Metrics(), Metrics()
+        metrics.add_time("read", 1.0)
+        metrics.add("cells_visited", 2)
+        worker.add_time("read", 0.5, calls=4)
+        worker.add("cells_visited", 3)
+        worker.add("ocean_cells_skipped")
+        metrics.merge(worker.report())
+        self.assertEqual(metrics.stages["read"], {"seconds": 1.5, "calls": 5})
+        self.assertEqual(metrics.counters, {"cells_visited": 5, "ocean_cells_skipped": 1})
+
+    def test_progress_throttled(self):
+        """Test progress is printed at most once per interval unless forced."""
+        stream = io.StringIO()
+        metrics = Metrics(progress_interval=60, stream=stream)
+        with mock.patch("time.perf_counter", side_effect=[0.0, 1.0, 2.0, 61.0]):
+            metrics.progress("first")
+            metrics.progress("second")
+            metrics.progress("third", force=True)
+            metrics.progress("fourth")
+        self.assertEqual(stream.getvalue(), "first\rthird\r")
+
+    def test_write_report(self):
+        """Test the report is written as JSON."""
+        path = os.path.join(self.directory, "metrics.json")
+        metrics = Metrics()
+        metrics.add("entries", 5)
+        metrics.write_report(path)
+        with open(path) as report_file:
+            self.assertEqual(json.load(report_file)["counters"], {"entries": 5})
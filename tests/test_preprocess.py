@@ -1,12 +1,19 @@
+import json
 import os.path
 import tempfile
+import multiprocessing
+from unittest import mock
 
 import h5py
+import numpy as np
 from unittest import TestCase
 from pylint import epylint as lint
-from fireemissionsai import preprocess
+from fireemissionsai import dataset, predict, preprocess
+from tests.fixtures import (
+    TemporaryDirectoryTestCase, split_files, write_gfed_file, write_gfed_files
+)
 
-class TestValidator(TestCase):
+class TestValidator(TemporaryDirectoryTestCase):
     """Test the preprocess.Validator."""
 
     def test_valid_arguments(self):
@@ -26,8 +33,33 @@ class TestValidator(TestCase):
         # Providing GFED format hdf file is valid.
         self.assertTrue(preprocess.valid_hdf_structure("tests/resources/min_2018.hdf5"))
 
+    def test_valid_files_manifest(self):
+        """Test validation results are cached in a manifest until a file changes."""
+        directory = self.directory + os.sep
+        write_gfed_files(directory)
+        h5py.File(os.path.join(directory, "GFED_2018.hdf5"), 'w').close()
+        manifest = os.path.join(directory, "output", "manifest.json")
+        files = preprocess.valid_files(directory, manifest, workers=2)
+        self.assertEqual([os.path.basename(hdf.filename) for hdf in files],
+                         ["GFED_2016.hdf5", "GFED_2017.hdf5"])
+        for hdf in files:
+            hdf.close()
 
-class TestParser(TestCase):
+        with mock.patch.object(preprocess, "valid_hdf_structure", return_value=True) as check:
+            files = preprocess.valid_files(directory, manifest)
+            self.assertEqual(len(files), 2)
+            self.assertEqual(check.call_count, 0)
+            for hdf in files:
+                hdf.close()
+            write_gfed_file(os.path.join(directory, "GFED_2018.hdf5"))
+            files = preprocess.valid_files(directory, manifest)
+            self.assertEqual(len(files), 3)
+            self.assertEqual(check.call_count, 1)
+            for hdf in files:
+                hdf.close()
+
+
+class TestParser(TemporaryDirectoryTestCase):
     """Test the preprocess.GFEDDataParser."""
 
     def test_incremement_and_has_nexts(self):
@@ -61,6 +93,356 @@ class TestParser(TestCase):
         self.assertFalse(parser.has_next_coordinate())
         self.assertFalse(parser.has_next())
 
+    def test_next_block_matches_next(self):
+        """Test next_block gives the same rows as next in slab and per-cell modes."""
+        files = self.open_files(write_gfed_files(self.directory))
+        for slabs in (False, True):
+            parser = preprocess.GFEDDataParser(files, slabs=slabs)
+            rows = []
+            while parser.has_next():
+                features, targets = parser.next()
+                if len(targets) != 0:
+                    rows.append((features, targets))
+            expected_features = np.array([row[0] for row in rows], dtype=np.float32)
+            expected_targets = np.array([row[1] for row in rows], dtype=np.float32)
+
+            parser = preprocess.GFEDDataParser(files, slabs=True)
+            # Starting part way through a column only gives the remaining rows.
+            parser.month, parser.i = 5, 1
+            blocks = [parser.next_block()]
+            while parser.has_next_block():
+                blocks.append(parser.next_block())
+            features = np.concatenate([block[0] for block in blocks])
+            targets = np.concatenate([block[1] for block in blocks])
+            np.testing.assert_array_equal(features, expected_features[16:])
+            np.testing.assert_array_equal(targets, expected_targets[16:])
+
+    def test_land_cells(self):
+        """Test walking a land cell index gives the same subsamples and blocks."""
+        paths = write_gfed_files(self.directory)
+        files = self.open_files(paths)
+        index_path = os.path.join(self.directory, "output", "land-index.npz")
+        land_cells = preprocess.load_land_cells(files, index_path)
+        self.assertTrue(os.path.isfile(index_path))
+        for cells, hdf in zip(preprocess.load_land_cells(files, index_path), files):
+            regions = hdf["ancill/basis_regions"][()]
+            self.assertTrue(np.all(regions[cells[:, 0], cells[:, 1]] != 0))
+            self.assertEqual(len(cells), np.count_nonzero(regions))
+
+        for ratio in (-1, 2):
+            samples = []
+            for cells in (None, land_cells):
+                parser = preprocess.GFEDDataParser(files, land_cells=cells)
+                with mock.patch.object(parser, "region", wraps=parser.region) as region:
+                    entries = preprocess.get_subsample(parser, ratio)
+                    while len(entries) != 0:
+                        samples.append(entries)
+                        entries = preprocess.get_subsample(parser, ratio)
+                # Cells of a land index are not looked up to skip the ocean.
+                self.assertEqual(region.called, cells is None)
+                samples.append(None)
+            split = samples.index(None)
+            self.assertEqual(samples[:split], samples[split + 1:-1])
+
+        full = preprocess.GFEDDataParser(files, slabs=True)
+        land = preprocess.GFEDDataParser(files, slabs=True, land_cells=land_cells)
+        expected = np.concatenate([full.next_block()[0] for _ in range(6)])
+        features = [land.next_block()[0] for _ in range(2)]
+        while land.has_next_block():
+            features.append(land.next_block()[0])
+        np.testing.assert_array_equal(np.concatenate(features), expected[expected[:, 4] != 0])
+
+        # A file replaced under the same name has its index rebuilt.
+        files[1].close()
+        write_gfed_file(paths[1], shape=(5, 3), seed=3)
+        files[1] = self.open_files(paths[1:])[0]
+        cells = preprocess.load_land_cells(files, index_path)[1]
+        np.testing.assert_array_equal(cells, preprocess.build_land_cells(files[1]))
+        with np.load(index_path) as archive:
+            self.assertEqual(len(archive.files), 2)
+
+    def test_bytes_read(self):
+        """Test the bytes counted as read cell by cell are those of the rows read."""
+        path = write_gfed_file(os.path.join(self.directory, "GFED_2016.hdf5"), (4, 30))
+        with h5py.File(path, 'r') as hdf:
+            parser = preprocess.GFEDDataParser([hdf])
+            parser.next()
+            rows = 3 + 2 * len(preprocess.MONTHLY_DATASETS)
+            self.assertEqual(
+                parser.metrics.counters["hdf_bytes_read"], rows * hdf["lat"][0].nbytes
+            )
+
+    def test_grid_features(self):
+        """Test grid_features gives the same rows as get_entry for every land cell."""
+        path = write_gfed_file(os.path.join(self.directory, "GFED_2016.hdf5"))
+        with h5py.File(path, 'r') as hdf:
+            cells, features = preprocess.grid_features(hdf, 7)
+            parser = preprocess.GFEDDataParser([hdf])
+            parser.month = 7
+            expected = [parser.get_entry(i, j) for i, j in cells]
+            self.assertEqual(len(cells), np.count_nonzero(hdf["ancill/basis_regions"][()]))
+            blocks = list(preprocess.grid_feature_blocks(hdf, 7, 4))
+        np.testing.assert_array_equal(features, np.array(expected, dtype=np.float32))
+        self.assertTrue(all(len(block[1]) <= 4 for block in blocks))
+        np.testing.assert_array_equal(np.concatenate([block[0] for block in blocks]), cells)
+        np.testing.assert_array_equal(np.concatenate([block[1] for block in blocks]), features)
+
+        # Forecasts predict each chunk of cells' features as it is built.
+        chunks = []
+        def predict_fn(rows):
+            chunks.append(len(rows))
+            return rows[:, 5:]
+        output_path = os.path.join(self.directory, "forecast.hdf5")
+        predict.forecast_grid(predict_fn, path, 7, output_path, chunk_rows=4)
+        self.assertEqual(chunks, [len(block[1]) for block in blocks])
+        with h5py.File(output_path, 'r') as output:
+            np.testing.assert_array_equal(
+                output["BB"][()][cells[:, 0], cells[:, 1]], features[:, 5]
+            )
+
+    def test_neighbourhood_window(self):
+        """Test window entries hold the surrounding cells, wrapping in longitude."""
+        files = self.open_files(write_gfed_files(self.directory, shape=(5, 6)))
+        with self.assertRaises(ValueError):
+            preprocess.GFEDDataParser(files, window=4)
+        parser = preprocess.GFEDDataParser(files, window=3)
+        slab = np.stack([files[0][name.format(3)][()] for name in preprocess.MONTHLY_DATASETS])
+        parser.month = 3
+        entry = parser.get_entry(0, 5)
+        self.assertEqual(len(entry), 5 + 6 * 9)
+        expected = np.zeros((6, 3, 3), dtype=np.float32)
+        expected[:, 1:, :] = slab[:, 0:2][:, :, [4, 5, 0]]
+        np.testing.assert_array_equal(np.array(entry[5:], dtype=np.float32), expected.ravel())
+        centre = preprocess.GFEDDataParser(files, slabs=True)
+        centre.month = 3
+        np.testing.assert_array_equal(
+            np.array(entry[:5] + [entry[5 + 4 + 9 * k] for k in range(6)], dtype=np.float32),
+            np.array(centre.get_entry(0, 5), dtype=np.float32)
+        )
+
+        parser = preprocess.GFEDDataParser(files, window=3)
+        rows = []
+        while parser.has_next():
+            features, targets = parser.next()
+            if len(targets) != 0:
+                rows.append(features)
+        parser = preprocess.GFEDDataParser(files, window=3)
+        blocks = []
+        while parser.has_next_block():
+            blocks.append(parser.next_block()[0])
+        np.testing.assert_array_equal(np.concatenate(blocks), np.array(rows, dtype=np.float32))
+
+        cells, features = preprocess.grid_features(files[0], 3, window=3)
+        parser = preprocess.GFEDDataParser(files, window=3)
+        parser.month = 3
+        expected = [parser.get_entry(i, j) for i, j in cells]
+        np.testing.assert_array_equal(features, np.array(expected, dtype=np.float32))
+
+    def test_sample_block(self):
+        """Test stratified sampling keeps positives and ratio times as many negatives."""
+        rng = np.random.RandomState(0)
+        features = rng.rand(1000, 11)
+        features[:100, 4] = 0
+        targets = rng.rand(1000, 6)
+        targets[rng.rand(1000) < 0.9, -1] = 0
+        land = features[:, 4] != 0
+        positives = np.count_nonzero(land & (targets[:, -1] != 0))
+
+        kept_x, kept_y = preprocess.sample_block(features, targets, -1, rng)
+        np.testing.assert_array_equal(kept_x, features[land])
+        for ratio in (1, 3, 100):
+            kept_x, kept_y = preprocess.sample_block(
+                features, targets, ratio, np.random.RandomState(ratio)
+            )
+            self.assertEqual(np.count_nonzero(kept_y[:, -1] != 0), positives)
+            self.assertEqual(
+                np.count_nonzero(kept_y[:, -1] == 0),
+                min(ratio * positives, np.count_nonzero(land) - positives)
+            )
+            self.assertTrue(np.all(kept_x[:, 4] != 0))
+            # Rows keep their order and the sample is reproducible from the seed.
+            order = [np.flatnonzero((features == row).all(axis=1))[0] for row in kept_x]
+            self.assertEqual(order, sorted(order))
+            again = preprocess.sample_block(features, targets, ratio, np.random.RandomState(ratio))
+            np.testing.assert_array_equal(again[0], kept_x)
+
+
+class TestValidateAndParse(TemporaryDirectoryTestCase):
+    """Test the preprocess.validate_and_parse output."""
+
+    def test_workers_match_serial(self):
+        """Test parsing with a process pool writes the same splits as parsing serially."""
+        write_gfed_files(self.directory, (2015, 2016, 2017))
+        self.change_directory()
+        for size, ratio in ((1000, -1), (1000, 1), (1000, 3), (40, 2)):
+            outputs = []
+            for workers in (1, 2):
+                preprocess.validate_and_parse(
+                    self.directory + os.sep, size, ratio, land_index=workers > 1, workers=workers
+                )
+                outputs.append(split_files("csv"))
+            self.assertEqual(len(outputs[0]), 6)
+            self.assertTrue(len(outputs[0]["train-features.csv"]) > 0)
+            self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(os.listdir(os.path.join("output", "shards")), [])
+
+    def test_npy_format(self):
+        """Test splits written as .npy hold the same values as those written as .csv."""
+        write_gfed_files(self.directory)
+        self.change_directory()
+        splits = {}
+        for file_format in dataset.FORMATS:
+            preprocess.validate_and_parse(self.directory + os.sep, 100, 2, file_format=file_format)
+            splits[file_format] = {
+                (split, kind): dataset.load_split(split, kind)
+                for split in dataset.SPLITS for kind in ("features", "targets")
+            }
+        self.assertIsInstance(splits["npy"][("train", "features")], np.memmap)
+        for key, csv in splits["csv"].items():
+            np.testing.assert_array_equal(splits["npy"][key], csv.astype(np.float32))
+
+    def test_metrics_report(self):
+        """Test a metrics report is written with stage timings and counters."""
+        write_gfed_files(self.directory)
+        self.change_directory()
+        for workers in (1, 2):
+            preprocess.validate_and_parse(
+                self.directory + os.sep, 50, 2, workers=workers, metrics_path="metrics.json"
+            )
+            with open("metrics.json") as report_file:
+                report = json.load(report_file)
+            for stage in ("validation", "subsample", "write", "hdf_read"):
+                self.assertIn(stage, report["stages"])
+            self.assertEqual(report["counters"]["entries"], 50)
+            self.assertTrue(report["counters"]["cells_visited"] > 0)
+            self.assertTrue(report["counters"]["hdf_bytes_read"] > 0)
+            self.assertIn("entries_per_second", report["rates"])
+
+    def test_slab_cache(self):
+        """Test parsing with a cold or warm cache writes the same splits as parsing without."""
+        write_gfed_files(self.directory)
+        self.change_directory()
+        outputs, reports = [], []
+        for cache_directory, workers in ((None, 1), ("cache", 1), ("cache", 1), ("cache", 2)):
+            preprocess.validate_and_parse(
+                self.directory + os.sep, 100, 2, workers=workers, metrics_path="metrics.json",
+                cache_directory=cache_directory
+            )
+            outputs.append(split_files("csv"))
+            with open("metrics.json") as report_file:
+                reports.append(json.load(report_file)["counters"])
+        for output in outputs[1:]:
+            self.assertEqual(output, outputs[0])
+        self.assertTrue(reports[1]["cache_misses"] > 0)
+        self.assertNotIn("cache_hits", reports[1])
+        self.assertNotIn("cache_misses", reports[2])
+        self.assertTrue(reports[2]["cache_hits"] > 0)
+        # Only the lat, lon, and basis_regions arrays are still read from HDF files.
+        self.assertTrue(reports[2]["hdf_bytes_read"] < reports[1]["hdf_bytes_read"] / 10)
+
+    def test_prefetch(self):
+        """Test prefetching months in a reader process writes the same splits as parsing without."""
+        paths = write_gfed_files(self.directory, (2015, 2016, 2017))
+        self.change_directory()
+        for options in ({}, {"stratified": True}, {"land_index": True}):
+            outputs = []
+            for prefetch in (0, 2):
+                preprocess.validate_and_parse(
+                    self.directory + os.sep, 150, 2, prefetch=prefetch,
+                    metrics_path="metrics.json", **options
+                )
+                outputs.append(split_files("csv"))
+                with open("metrics.json") as report_file:
+                    stages = json.load(report_file)["stages"]
+                self.assertEqual("prefetch_wait" in stages, prefetch > 0)
+            self.assertTrue(len(outputs[0]["train-features.csv"]) > 0)
+            self.assertEqual(outputs[1], outputs[0])
+            # The reader process stops once parsing is done.
+            self.assertEqual(multiprocessing.active_children(), [])
+
+        files = self.open_files(paths)
+        parser = preprocess.GFEDDataParser(files, prefetch=1)
+        expected = preprocess.GFEDDataParser(files, slabs=True)
+        np.testing.assert_array_equal(parser.next_block()[0], expected.next_block()[0])
+        parser.close()
+        self.assertFalse(os.path.isdir(parser.cache.directory))
+
+    def test_resume(self):
+        """Test resuming from a checkpoint writes the same splits as one uninterrupted run."""
+        write_gfed_files(self.directory)
+        self.change_directory()
+        for file_format, workers in (("csv", 1), ("npy", 2)):
+            options = dict(
+                ratio=3, workers=workers, file_format=file_format,
+                checkpoint_path="output/checkpoint.json"
+            )
+            preprocess.validate_and_parse(self.directory + os.sep, 90, **options)
+            expected = split_files(file_format)
+            preprocess.validate_and_parse(self.directory + os.sep, 37, **options)
+            # Anything written after the checkpoint was saved is discarded.
+            for name in expected:
+                with open(os.path.join("output", name), "ab") as split_file:
+                    split_file.write(b"1,2,3\n")
+            preprocess.validate_and_parse(self.directory + os.sep, 90, resume=True, **options)
+            self.assertEqual(split_files(file_format), expected)
+
+    def test_append(self):
+        """Test appending a new year's file writes the same splits as parsing every file."""
+        self.change_directory()
+        write_gfed_files(self.directory, (2015, 2016))
+        with self.assertRaisesRegex(ValueError, "No checkpoint saved"):
+            preprocess.validate_and_parse(
+                self.directory + os.sep, 10000, 1, checkpoint_path="output/checkpoint.json",
+                append=True
+            )
+        preprocess.validate_and_parse(
+            self.directory + os.sep, 10000, 1, checkpoint_path="output/checkpoint.json"
+        )
+        before = split_files("csv")
+        write_gfed_file(os.path.join(self.directory, "GFED_2017.hdf5"), seed=2017)
+        preprocess.validate_and_parse(
+            self.directory + os.sep, 10000, 1, checkpoint_path="output/checkpoint.json", append=True
+        )
+        appended = split_files("csv")
+        preprocess.validate_and_parse(self.directory + os.sep, 10000, 1)
+        self.assertEqual(appended, split_files("csv"))
+        for name, values in before.items():
+            self.assertTrue(appended[name].startswith(values))
+            self.assertTrue(len(appended[name]) > len(values))
+
+        with self.assertRaises(ValueError):
+            preprocess.validate_and_parse(
+                self.directory + os.sep, 10000, 2, checkpoint_path="output/checkpoint.json",
+                resume=True
+            )
+
+        # A run stopped by size is appended to from where it stopped, as with a larger size.
+        preprocess.validate_and_parse(
+            self.directory + os.sep, 20, 1, checkpoint_path="output/checkpoint.json"
+        )
+        preprocess.validate_and_parse(
+            self.directory + os.sep, 20, 1, checkpoint_path="output/checkpoint.json", append=True
+        )
+        appended = split_files("csv")
+        preprocess.validate_and_parse(self.directory + os.sep, 40, 1)
+        self.assertEqual(appended, split_files("csv"))
+        years = np.genfromtxt("output/train-features.csv", delimiter=",")[:, 0]
+        self.assertEqual(set(years), {2015})
+
+    def test_stratified(self):
+        """Test stratified sampling is reproducible, resumable, and keeps positives."""
+        write_gfed_files(self.directory, (2015, 2016, 2017))
+        self.change_directory()
+        options = dict(stratified=True, seed=5, checkpoint_path="output/checkpoint.json")
+        preprocess.validate_and_parse(self.directory + os.sep, 1000, 1, **options)
+        expected = split_files("csv")
+        targets = np.genfromtxt("output/train-targets.csv", delimiter=",", ndmin=2)
+        positives = np.count_nonzero(targets[:, -1] != 0)
+        self.assertTrue(0 < positives < len(targets))
+        preprocess.validate_and_parse(self.directory + os.sep, 13, 1, **options)
+        preprocess.validate_and_parse(self.directory + os.sep, 1000, 1, resume=True, **options)
+        self.assertEqual(split_files("csv"), expected)
+
 class TestzPylint(TestCase):
     """Runs Pylint on the preprocess.py."""
 
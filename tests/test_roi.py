@@ -0,0 +1,175 @@
+import os.path
+
+import h5py
+import numpy as np
+from fireemissionsai import preprocess
+from fireemissionsai.cache import SlabCache
+from fireemissionsai.roi import RegionOfInterest, read_box
+from tests.fixtures import TemporaryDirectoryTestCase, split_files, write_gfed_files
+
+# Small chunked GFED files sharing their land layout, for reading boxes of chunks.
+CHUNKED = dict(shape=(12, 24), chunks=(4, 4), compression="gzip", shared_land=True)
+
+class TestRegionOfInterest(TemporaryDirectoryTestCase):
+    """Test the roi.RegionOfInterest cells and the boxes read around them."""
+
+    def test_cells(self):
+        """Test the cells of a region are the land cells in its box and basis regions."""
+        path = write_gfed_files(self.directory, **CHUNKED)[0]
+        with h5py.File(path, "r") as hdf:
+            lat, lon = hdf["lat"][()], hdf["lon"][()]
+            regions = hdf["ancill/basis_regions"][()]
+            for bbox, ids in (((-30, 45, -100, 60), None), (None, [3, 5]),
+                              ((-90, 90, 150, -150), None), ((-20, 20, 0, 90), [1, 8, 9])):
+                cells = RegionOfInterest(bbox, ids).cells(hdf)
+                inside = regions != 0
+                if bbox is not None:
+                    inside &= (lat >= bbox[0]) & (lat <= bbox[1])
+                    if bbox[2] <= bbox[3]:
+                        inside &= (lon >= bbox[2]) & (lon <= bbox[3])
+                    else:
+                        inside &= (lon >= bbox[2]) | (lon <= bbox[3])
+                if ids is not None:
+                    inside &= np.isin(regions, ids)
+                j, i = np.nonzero(inside.T)
+                np.testing.assert_array_equal(cells, np.stack([i, j], axis=1))
+                self.assertTrue(len(cells) > 0)
+        with self.assertRaises(ValueError):
+            RegionOfInterest(months=(0, 5))
+        with self.assertRaises(ValueError):
+            RegionOfInterest(bbox=(10, -10, 0, 10))
+
+    def test_read_box(self):
+        """Test boxes are widened to chunks and read every column when they wrap."""
+        cells = [np.array([[5, 6], [6, 9]])]
+        self.assertEqual(read_box(cells, (12, 24)), (slice(5, 7), slice(6, 10)))
+        self.assertEqual(read_box(cells, (12, 24), (4, 4)), (slice(4, 8), slice(4, 12)))
+        self.assertEqual(read_box(cells, (12, 24), (4, 4), pad=2), (slice(0, 12), slice(4, 12)))
+        self.assertEqual(
+            read_box([np.array([[0, 0]])], (12, 24), pad=1), (slice(0, 2), slice(0, 24))
+        )
+        self.assertEqual(read_box([np.empty((0, 2))], (12, 24)), (slice(0, 0), slice(0, 0)))
+
+    def test_parse_region(self):
+        """Test parsing a region gives the entries inside it, reading less of each file."""
+        files = self.open_files(write_gfed_files(self.directory, **CHUNKED))
+        roi = RegionOfInterest((-45, 30, -120, 45), [2, 4, 5, 6, 7], months=(3, 10))
+        cells = {tuple(cell) for cell in roi.cells(files[0])}
+        for window in (1, 3):
+            full = preprocess.GFEDDataParser(files, slabs=True, window=window)
+            region = preprocess.GFEDDataParser(files, window=window, roi=roi)
+            # Only the first cell walked of the last file is parsed, which differs in a region.
+            expected = [
+                entry for entries in preprocess.subsamples(full, -1) for entry in entries
+                if entry[0][0] != "2017" and 3 <= entry[0][1] <= 10 and (
+                    int(np.flatnonzero(files[0]["lat"][:, 0] == entry[0][2])[0]),
+                    int(np.flatnonzero(files[0]["lon"][0, :] == entry[0][3])[0])
+                ) in cells
+            ]
+            entries = [
+                entry for entries in preprocess.subsamples(region, -1) for entry in entries
+                if entry[0][0] != "2017"
+            ]
+            self.assertTrue(len(entries) > 0)
+            self.assertEqual(entries, expected)
+            self.assertTrue(
+                region.metrics.counters["hdf_bytes_read"] < full.metrics.counters["hdf_bytes_read"]
+            )
+
+            full = preprocess.GFEDDataParser(files, slabs=True, window=window)
+            region = preprocess.GFEDDataParser(files, window=window, roi=roi)
+            blocks = []
+            while full.has_next_block():
+                blocks.append(full.next_block())
+            features = np.concatenate([block[0] for block in blocks])
+            targets = np.concatenate([block[1] for block in blocks])
+            keep = np.array([
+                3 <= row[1] <= 10 and (
+                    int(np.flatnonzero(files[0]["lat"][:, 0] == row[2])[0]),
+                    int(np.flatnonzero(files[0]["lon"][0, :] == row[3])[0])
+                ) in cells
+                for row in features
+            ])
+            blocks = []
+            while region.has_next_block():
+                blocks.append(region.next_block())
+            np.testing.assert_array_equal(np.concatenate([b[0] for b in blocks]), features[keep])
+            np.testing.assert_array_equal(np.concatenate([b[1] for b in blocks]), targets[keep])
+
+    def test_cache_region(self):
+        """Test only a region's box of each dataset is read into a cache, keyed on the box."""
+        files = self.open_files(write_gfed_files(self.directory, **CHUNKED))
+        roi = RegionOfInterest((-45, 30, -120, 45), [2, 4, 5, 6, 7])
+        other = RegionOfInterest((-90, -30, -180, 180))
+        blocks, bytes_read = {}, {}
+        for name, kwargs in (("none", {}), ("cache", {"cache": True}),
+                             ("hit", {"cache": True}), ("prefetch", {"prefetch": 3}),
+                             ("other", {"cache": True, "roi": other})):
+            if kwargs.get("cache"):
+                kwargs["cache"] = SlabCache(os.path.join(self.directory, "cache"))
+            parser = preprocess.GFEDDataParser(files, **dict({"roi": roi}, **kwargs))
+            self.addCleanup(parser.close)
+            features = []
+            while parser.has_next_block():
+                features.append(parser.next_block()[0])
+            blocks[name] = np.concatenate(features)
+            bytes_read[name] = parser.metrics.counters["hdf_bytes_read"]
+            parser.close()
+        for name in ("cache", "hit", "prefetch"):
+            np.testing.assert_array_equal(blocks[name], blocks["none"])
+        self.assertEqual(bytes_read["cache"], bytes_read["none"])
+        # The reader process reads the same box, and on hits only the ancillary datasets are read.
+        self.assertEqual(bytes_read["prefetch"], bytes_read["none"])
+        self.assertTrue(bytes_read["hit"] < bytes_read["none"] / 10)
+        # Another region's box is read rather than cropped from the first's.
+        self.assertTrue(bytes_read["other"] > bytes_read["hit"])
+        rows, columns = preprocess.GFEDDataParser(files, roi=roi).box
+        cached = SlabCache(os.path.join(self.directory, "cache")).entries()
+        sizes = {np.load(path, mmap_mode="r").shape for _, _, path in cached}
+        self.assertIn((rows.stop - rows.start, columns.stop - columns.start), sizes)
+        self.assertNotIn(files[0]["ancill/basis_regions"].shape, sizes)
+
+    def test_parse_years(self):
+        """Test the last year of a range is parsed in full, with targets from the next file."""
+        paths = write_gfed_files(self.directory, (2015, 2016, 2017), **CHUNKED)
+        files = self.open_files(paths)
+        roi = RegionOfInterest(years=(2015, 2016))
+        selected = roi.select_files(files, [preprocess.file_year(path) for path in paths])
+        self.assertEqual(selected, files)
+        full = preprocess.GFEDDataParser(files, slabs=True)
+        expected = [
+            entry for entries in preprocess.subsamples(full, -1) for entry in entries
+            if entry[0][0] in ("2015", "2016")
+        ]
+        entries = [
+            entry for entries in preprocess.subsamples(
+                preprocess.GFEDDataParser(selected, roi=roi), -1
+            ) for entry in entries
+        ]
+        self.assertEqual(entries, expected)
+        self.assertEqual(
+            sum(entry[0][0] == "2016" for entry in entries),
+            sum(entry[0][0] == "2015" for entry in entries)
+        )
+        self.assertEqual(roi.select_files(files[1:], ["2016", "2017"]), files[1:])
+        self.assertEqual(roi.select_files(files[:2], ["2015", "2016"]), files[:2])
+        self.assertEqual(RegionOfInterest(years=(2019, 2020)).select_files(
+            files, [preprocess.file_year(path) for path in paths]
+        ), [])
+
+    def test_validate_and_parse_region(self):
+        """Test a region's years are selected and workers write the same splits as serially."""
+        write_gfed_files(self.directory, (2015, 2016, 2017, 2018), **CHUNKED)
+        self.change_directory()
+        roi = RegionOfInterest((-60, 60, -180, 180), years=(2016, 2017), months=(2, 11))
+        outputs = []
+        for workers in (1, 2):
+            preprocess.validate_and_parse(
+                self.directory + os.sep, 1000, 2, workers=workers, roi=roi
+            )
+            outputs.append(split_files("csv"))
+        self.assertEqual(outputs[0], outputs[1])
+        features = np.genfromtxt(os.path.join("output", "train-features.csv"), delimiter=",")
+        self.assertEqual(set(features[:, 0]), {2016, 2017})
+        self.assertTrue(np.all((features[:, 1] >= 2) & (features[:, 1] <= 11)))
+        self.assertTrue(np.all(np.abs(features[:, 2]) <= 60))
@@ -0,0 +1,130 @@
+import os.path
+import json
+import socket
+import threading
+from http.client import HTTPConnection
+
+import numpy as np
+from unittest import TestCase
+from fireemissionsai import serve
+from tests.fixtures import TemporaryDirectoryTestCase
+
+class RecordingModel:
+    """A stand in model that records the size of each batch it predicts."""
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.release = threading.Event()
+
+    def predict(self, rows):
+        self.release.wait(5)
+        self.batch_sizes.append(len(rows))
+        return rows[:, :2] * 2
+
+
+class TestMicroBatcher(TestCase):
+    """Test the serve.MicroBatcher."""
+
+    def test_merges_concurrent_requests(self):
+        """Test requests submitted together are predicted in one batch with the right rows."""
+        model = RecordingModel()
+        batcher = serve.MicroBatcher(model.predict, max_batch_size=100, max_wait=0.5)
+        blocker = batcher.submit(np.zeros((1, 3)))
+        requests = [batcher.submit(np.full((n, 3), n, dtype=np.float32)) for n in (1, 2, 3)]
+        model.release.set()
+        blocker.result()
+        for n, request in zip((1, 2, 3), requests):
+            np.testing.assert_array_equal(request.result(), np.full((n, 2), 2 * n))
+        batcher.stop()
+        self.assertEqual(sum(model.batch_sizes), 7)
+        self.assertTrue(len(model.batch_sizes) <= 3)
+        stats = batcher.stats()
+        self.assertEqual(stats["requests"], 4)
+        self.assertEqual(stats["rows"], 7)
+        self.assertEqual(stats["batches"], len(model.batch_sizes))
+        self.assertTrue(stats["latency_p95_ms"] > 0)
+
+    def test_max_batch_size_and_errors(self):
+        """Test batches stop growing at the max size and rows that are not 2D are rejected."""
+        model = RecordingModel()
+        model.release.set()
+        batcher = serve.MicroBatcher(model.predict, max_batch_size=4, max_wait=0.2)
+        requests = [batcher.submit(np.ones((2, 3))) for _ in range(4)]
+        for request in requests:
+            request.result()
+        self.assertTrue(max(model.batch_sizes) <= 4)
+        with self.assertRaises(ValueError):
+            batcher.submit(np.ones((2,)))
+        with self.assertRaises(ValueError):
+            batcher.submit(np.ones((0, 3)))
+        batcher.stop()
+        self.assertEqual(batcher.stats()["errors"], 0)
+
+    def test_mismatched_columns(self):
+        """Test a request with the wrong number of columns fails without failing others."""
+        model = RecordingModel()
+
+        def predict(rows):
+            if rows.shape[1] != 3:
+                raise ValueError("Expected 3 columns")
+            return model.predict(rows)
+
+        batcher = serve.MicroBatcher(predict, max_batch_size=100, max_wait=0.5)
+        blocker = batcher.submit(np.zeros((1, 3)))
+        requests = [batcher.submit(np.ones((2, columns))) for columns in (3, 2, 3)]
+        model.release.set()
+        blocker.result()
+        np.testing.assert_array_equal(requests[0].result(), np.full((2, 2), 2))
+        np.testing.assert_array_equal(requests[2].result(), np.full((2, 2), 2))
+        with self.assertRaises(ValueError):
+            requests[1].result()
+        batcher.stop()
+        self.assertEqual(batcher.stats()["errors"], 1)
+
+
+class TestServer(TemporaryDirectoryTestCase):
+    """Test the prediction HTTP server."""
+
+    def test_http_and_unix_socket(self):
+        """Test .csv and JSON predictions and stats over a port and a Unix socket."""
+        model = RecordingModel()
+        model.release.set()
+        batcher = serve.MicroBatcher(model.predict, max_wait=0.001)
+        socket_path = os.path.join(self.directory, "predict.sock")
+        servers = (
+            serve.create_server(batcher, port=0),
+            serve.create_server(batcher, socket_path=socket_path)
+        )
+        for server in servers:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            if server.socket.family == socket.AF_UNIX:
+                connection = HTTPConnection("localhost")
+                connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                connection.sock.connect(socket_path)
+            else:
+                connection = HTTPConnection("127.0.0.1", server.server_address[1])
+
+            connection.request("POST", "/predict", "1,2,3\n4,5,6\n")
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            predictions = np.loadtxt(response.read().decode().splitlines(), delimiter=",")
+            np.testing.assert_array_equal(predictions, [[2, 4], [8, 10]])
+
+            connection.request("POST", "/predict", json.dumps({"inputs": [[1, 1, 1]]}),
+                               {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            self.assertEqual(json.loads(response.read())["predictions"], [[2, 2]])
+
+            for body in ("not,numbers\n", ""):
+                connection.request("POST", "/predict", body)
+                response = connection.getresponse()
+                response.read()
+                self.assertEqual(response.status, 400)
+
+            connection.request("GET", "/stats")
+            self.assertTrue(json.loads(connection.getresponse().read())["requests"] >= 2)
+            connection.close()
+            server.shutdown()
+            server.server_close()
+        batcher.stop()
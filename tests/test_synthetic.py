@@ -0,0 +1,45 @@
+import os.path
+
+import h5py
+import numpy as np
+from unittest import TestCase
+from fireemissionsai import benchmark, preprocess, synthetic
+from tests.fixtures import TemporaryDirectoryTestCase
+
+class TestSynthetic(TemporaryDirectoryTestCase):
+    """Test the synthetic GFED file generator."""
+
+    def test_generate(self):
+        """Test generated files are valid GFED files sharing a land layout of the right size."""
+        paths = synthetic.generate(self.directory, 2, (36, 72), land_fraction=0.25, first_year=2010)
+        self.assertEqual([os.path.basename(path) for path in paths],
+                         ["GFED4.1s_2010.hdf5", "GFED4.1s_2011.hdf5"])
+        regions = []
+        for path in paths:
+            self.assertTrue(preprocess.valid_hdf_file(path))
+            self.assertTrue(preprocess.valid_hdf_structure(path))
+            with h5py.File(path, "r") as hdf:
+                regions.append(hdf["ancill/basis_regions"][()])
+                burned = hdf["burned_area/06/burned_fraction"]
+                self.assertEqual(burned.compression, "gzip")
+                self.assertEqual(burned.chunks, (36, 72))
+                self.assertTrue(np.all(burned[()][regions[-1] == 0] == 0))
+                self.assertTrue(np.any(burned[()] > 0))
+                self.assertAlmostEqual(hdf["lat"][0, 0], 87.5)
+        np.testing.assert_array_equal(regions[0], regions[1])
+        self.assertAlmostEqual(np.mean(regions[0] != 0), 0.25, places=2)
+
+
+class TestBenchmark(TestCase):
+    """Test the preprocess and predict benchmark suite."""
+
+    def test_benchmark_report(self):
+        """Test a small benchmark run reports every hot path and finds regressions."""
+        report = benchmark.benchmark(years=2, shape=(8, 16), limit=200)
+        for name in ("parse_next_cells", "parse_blocks_land", "subsample_land_slabs", "write_npy"):
+            self.assertTrue(report["results"][name]["rows"] > 0)
+            self.assertTrue(report["results"][name]["rows_per_second"] > 0)
+        self.assertEqual(report["config"]["shape"], [8, 16])
+        self.assertEqual(benchmark.regressions(report, report, 0.2), [])
+        faster = {"results": {"write_npy": {"rows_per_second": 1e12}}}
+        self.assertEqual(len(benchmark.regressions(report, faster, 0.2)), 1)